@@ -0,0 +1,248 @@
+import atexit
+import functools
+import hashlib
+import json
+import pickle
+import sys
+import threading
+import time
+import urllib.request
+import uuid
+from collections import Counter, deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# dl stands for data lineage
+# The signal handlers only put a compact tuple into a ring buffer; a background thread drains it in batches,
+# collapses the per-activity/per-exchange records into one summary event per run and flushes the events as
+# OpenLineage run events (JSON lines) to a local file or to an HTTP endpoint such as a local Marquez.
+
+PRODUCER = "https://github.com/brightway-lca/brightway2/discussions/87"
+SCHEMA_URL = "https://openlineage.io/spec/2-0-2/OpenLineage.json#/$defs/RunEvent"
+SKIPPED_MODULES = ("blinker", "bw2data", "peewee", "dl_collector")  # frames skipped when looking for the call site
+
+
+class LineageCollector:
+    def __init__(self, namespace="brightway", job="bw2data", transport="file", path="lineage-events.json",
+                 url="http://localhost:5000/api/v1/lineage", capacity=2**16, batch_size=4096, interval=1.0, sample_every=1000):
+        self.namespace = namespace
+        self.job = job
+        self.transport = transport
+        self.path = path
+        self.url = url
+        self.buffer = deque(maxlen=capacity)  # ring buffer: the oldest records are dropped (and counted) when the flusher falls behind
+        self.batch_size = batch_size
+        self.interval = interval
+        self.sample_every = sample_every  # every n-th record carries its call site
+        self.seen = 0
+        self.dropped = 0
+        self.run_id = None
+        self.summary = None
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.emit_lock = threading.Lock()
+        self.closed = False
+        self.local = threading.local()  # open bulk operations of each thread
+        self.start_run()
+        self.thread = threading.Thread(target=self._flush_loop, name="lineage-flush", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    # Called from the signal handlers: O(1), no I/O; inside a bulk operation on 'database' the record is only folded into it
+    def record(self, kind, database, identifier=None, call_site=False, row=None):
+        operation = self._bulk_operation(database)
+        if operation is not None:
+            operation["rows"] += 1
+            operation["digest"].update(pickle.dumps((kind, identifier, getattr(row, "data", row)), protocol=4))
+            return
+        self.seen += 1
+        if call_site or self.seen % self.sample_every == 0:
+            call_site = self.call_site()
+        else:
+            call_site = None
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append((time.time(), kind, database, identifier, call_site))
+        if len(self.buffer) >= self.batch_size:
+            self.wakeup.set()
+
+    # Bulk operation on the dataset 'database' (Database.write, importer write_database or a scripted loop of saves):
+    # the per-row events of the block are suppressed, counted and folded into a SHA-256 content digest as they arrive,
+    # and one aggregated event is emitted when the block ends. Nested blocks on the same dataset are merged into the outer one
+    @contextmanager
+    def bulk(self, database, operation="bulk"):
+        outer = self._bulk_operation(database)
+        if outer is not None:
+            yield outer
+            return
+        state = {"database": database, "operation": operation, "rows": 0, "digest": hashlib.sha256(),
+                 "started": time.time(), "call_site": self.call_site()}
+        stack = self.local.__dict__.setdefault("bulk", [])
+        stack.append(state)
+        try:
+            yield state
+        finally:
+            stack.remove(state)
+            self.seen += 1
+            self.buffer.append((time.time(), operation, database, None, dict(
+                state["call_site"] or {}, rows=state["rows"], digest=state["digest"].hexdigest(),
+                duration=time.time() - state["started"])))
+            self.wakeup.set()
+
+    # Folds the rows written in one go (e.g. the data dict of Database.write) into the open bulk operation on 'database'
+    def fold(self, database, rows):
+        operation = self._bulk_operation(database)
+        for key, row in rows:
+            operation["rows"] += 1 + len(row.get("exchanges", [])) if isinstance(row, dict) else 1
+            operation["digest"].update(pickle.dumps((key, row), protocol=4))
+
+    def _bulk_operation(self, database):
+        for operation in reversed(getattr(self.local, "bulk", ())):
+            if operation["database"] == database:
+                return operation
+        return None
+
+    # First frame outside bw2data/blinker/peewee (much cheaper than inspect.stack(), which reads the source of every frame)
+    @staticmethod
+    def call_site(depth=3):
+        frame = sys._getframe(depth)
+        lci_path = None
+        while frame is not None:
+            lci_path = lci_path or frame.f_locals.get("lci_path")
+            module = frame.f_globals.get("__name__", "")
+            if not module.startswith(SKIPPED_MODULES):
+                return {"module": module, "function": frame.f_code.co_name, "file": frame.f_code.co_filename,
+                        "line": frame.f_lineno, "lci_path": None if lci_path is None else str(lci_path)}
+            frame = frame.f_back
+        return None
+
+    def start_run(self):
+        with self.lock:
+            self.run_id = str(uuid.uuid4())
+            self.summary = {"started": time.time(), "counts": Counter(), "call_sites": deque(maxlen=100)}
+        self._emit([self._event("START", [])])
+
+    # Flushes the buffer and emits the run summary; the next records belong to a new run
+    def complete_run(self, new_run=True):
+        self.flush()
+        with self.lock:
+            events = [self._event("COMPLETE", self._outputs(), self._summary_facet())]
+        self._emit(events)
+        if new_run:
+            self.start_run()
+
+    def flush(self):
+        records = []
+        while self.buffer:
+            try:
+                records.append(self.buffer.popleft())
+            except IndexError:
+                break
+        if not records:
+            return
+        with self.lock:
+            for t, kind, database, identifier, call_site in records:
+                self.summary["counts"][(kind, database)] += call_site["rows"] if call_site and "rows" in call_site else 1
+                if call_site is not None:
+                    self.summary["call_sites"].append(dict(call_site, kind=kind, database=database, time=t))
+            events = [self._event("RUNNING", self._outputs(records), self._summary_facet())]
+        if not self._emit(events):
+            with self.lock:
+                self.dropped += len(records)  # already taken from the buffer: counted as dropped in the run summary
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join(timeout=5)
+        self.complete_run(new_run=False)
+
+    def _flush_loop(self):
+        while not self.closed:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as error:  # lineage must never break the import
+                print("lineage flush failed:", error, file=sys.stderr)
+
+    def _outputs(self, records=None):
+        if records is None:
+            counts = Counter({(database, kind): n for (kind, database), n in self.summary["counts"].items()})
+        else:
+            counts = Counter()
+            for _, kind, database, _, call_site in records:
+                counts[(database, kind)] += call_site["rows"] if call_site and "rows" in call_site else 1
+        datasets = {}
+        for (database, kind), n in counts.items():
+            datasets.setdefault(database, {})[kind] = n
+        outputs = [{"namespace": self.namespace, "name": database,
+                    "facets": {"brightwaySaves": dict(self._facet(), **kinds)}} for database, kinds in datasets.items()]
+        # Aggregated bulk operations: row count and content digest of the written rows
+        for _, kind, database, _, call_site in records or ():
+            if call_site and "digest" in call_site:
+                outputs.append({"namespace": self.namespace, "name": database, "facets": {
+                    "outputStatistics": dict(self._facet(), rowCount=call_site["rows"]),
+                    "brightwayBulkWrite": dict(self._facet(), operation=kind, digest=call_site["digest"], duration=call_site["duration"])}})
+        return outputs
+
+    def _summary_facet(self):
+        return {"brightwayRunSummary": dict(self._facet(), seen=self.seen, dropped=self.dropped,
+                                            started=self.summary["started"], call_sites=list(self.summary["call_sites"]))}
+
+    def _facet(self):
+        return {"_producer": PRODUCER, "_schemaURL": SCHEMA_URL}
+
+    def _event(self, event_type, outputs, facets=None):
+        return {"eventType": event_type, "eventTime": datetime.now(timezone.utc).isoformat(),
+                "run": {"runId": self.run_id, "facets": facets or {}},
+                "job": {"namespace": self.namespace, "name": self.job},
+                "inputs": [], "outputs": outputs, "producer": PRODUCER, "schemaURL": SCHEMA_URL}
+
+    # Writes the events; a failing transport (e.g. no endpoint running) is reported on stderr and never raised,
+    # since lineage must never break the import. Returns whether the events were written
+    def _emit(self, events):
+        with self.emit_lock:
+            try:
+                self._write(events)
+            except Exception as error:
+                print("lineage emit failed:", error, file=sys.stderr)
+                return False
+        return True
+
+    def _write(self, events):
+        if self.transport == "file":
+            with open(self.path, "a") as fp:
+                for event in events:
+                    fp.write(json.dumps(event, default=str) + "\n")
+        elif self.transport == "http":
+            for event in events:
+                request = urllib.request.Request(self.url, data=json.dumps(event, default=str).encode(),
+                                                 headers={"Content-Type": "application/json"})
+                urllib.request.urlopen(request, timeout=5).close()
+        else:
+            raise ValueError(f"Unknown transport '{self.transport}', use 'file' or 'http'")
+
+
+# Runs Database.write and importer write_database calls as bulk operations of 'collector' (one aggregated event each)
+def install_bulk_wrappers(collector):
+    from bw2data.backends import SQLiteBackend
+    from bw2io.importers.base_lci import LCIImporter
+
+    write = SQLiteBackend.write
+    write_database = LCIImporter.write_database
+
+    @functools.wraps(write)
+    def bulk_write(self, data, *args, **kwargs):
+        with collector.bulk(self.name, "Database.write"):
+            collector.fold(self.name, data.items())
+            return write(self, data, *args, **kwargs)
+
+    @functools.wraps(write_database)
+    def bulk_write_database(self, *args, **kwargs):
+        with collector.bulk(kwargs.get("db_name") or self.db_name, "write_database"):
+            return write_database(self, *args, **kwargs)
+
+    SQLiteBackend.write = bulk_write
+    LCIImporter.write_database = bulk_write_database
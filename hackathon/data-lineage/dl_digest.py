@@ -0,0 +1,128 @@
+import atexit
+import hashlib
+import json
+import os
+import pickle
+import time
+
+import bw2data as bd
+
+# dl stands for data lineage
+# Incremental Merkle-style digest of each database of the current project, kept up to date by the save signals:
+# every activity/exchange row has a 128-bit content hash, the row hashes are summed (mod 2**128) into 256 buckets chosen by
+# the row id, and the digest of a database is the SHA-256 of its buckets. Saving a row replaces its old hash in one bucket,
+# so a full rehash is never needed (only after Database.write, which replaces the whole database anyway).
+# The digests are written to <project dir>/lineage/digests.json ({database: digest}), where the PMC scripts read them
+# as version stamps (pmc_functions.db_version), and the row hashes to digest_trees.pickle in the same directory.
+
+BUCKETS = 256
+MODULUS = 2**128
+STAMPS_FILE = "digests.json"
+TREES_FILE = "digest_trees.pickle"
+
+
+def row_hash(content):
+    return int.from_bytes(hashlib.blake2b(json.dumps(content, sort_keys=True, default=str).encode(), digest_size=16).digest(), "big")
+
+
+def row_bucket(row_id):
+    return hashlib.blake2b(repr(row_id).encode(), digest_size=1).digest()[0]
+
+
+class DatabaseDigests:
+    def __init__(self, save_interval=10.0):
+        self.project = None
+        self.directory = None
+        self.trees = {}  # {database: {"rows": {row id: hash}, "buckets": [sum of row hashes, ...], "stamp": digest or None}}
+        self.save_interval = save_interval
+        self.saved = time.time()
+        atexit.register(self.save)
+
+    # Digest of 'database' (None if it was never digested): a cheap version stamp
+    def stamp(self, database):
+        tree = self._trees().get(database)
+        if tree is None:
+            return None
+        return self.stamp_of(tree)
+
+    # Replaces the hash of one row (activity: ("activity", code), exchange: ("exchange", id)) with the hash of 'content'
+    def update(self, database, row_id, content):
+        tree = self._trees().get(database)
+        if tree is None:
+            tree = self.rebuild(database)
+        new = row_hash(content)
+        old = tree["rows"].get(row_id, 0)
+        if new != old:
+            bucket = row_bucket(row_id)
+            tree["buckets"][bucket] = (tree["buckets"][bucket] - old + new) % MODULUS
+            tree["rows"][row_id] = new
+            tree["stamp"] = None
+            if time.time() - self.saved > self.save_interval:
+                self.save_stamps()
+
+    def activity_saved(self, activity_dataset):
+        self.update(activity_dataset.database, ("activity", activity_dataset.code), activity_dataset.data)
+
+    def exchange_saved(self, exchange_dataset):
+        self.update(exchange_dataset.output_database, ("exchange", exchange_dataset.id), exchange_dataset.data)
+
+    # Digests all rows of 'database' (after Database.write, or the first time a database is seen)
+    def rebuild(self, database):
+        from bw2data.backends import ActivityDataset, ExchangeDataset
+
+        tree = {"rows": {}, "buckets": [0] * BUCKETS, "stamp": None}
+        rows = [(("activity", code), data) for code, data in ActivityDataset.select(ActivityDataset.code, ActivityDataset.data)
+                .where(ActivityDataset.database == database).tuples()]
+        rows += [(("exchange", id), data) for id, data in ExchangeDataset.select(ExchangeDataset.id, ExchangeDataset.data)
+                 .where(ExchangeDataset.output_database == database).tuples()]
+        for row_id, data in rows:
+            h = tree["rows"][row_id] = row_hash(data)
+            bucket = row_bucket(row_id)
+            tree["buckets"][bucket] = (tree["buckets"][bucket] + h) % MODULUS
+        self._trees()[database] = tree
+        self.save()
+        return tree
+
+    def database_written(self, datastore):
+        self.rebuild(datastore.name)
+
+    def save_stamps(self):
+        if self.project is None:
+            return
+        stamps = {database: self.stamp_of(tree) for database, tree in self.trees.items()}
+        with open(os.path.join(self.directory, STAMPS_FILE), "w") as fp:
+            json.dump(stamps, fp, indent=1)
+        self.saved = time.time()
+
+    def save(self):
+        if self.project is None:
+            return
+        self.save_stamps()
+        with open(os.path.join(self.directory, TREES_FILE), "wb") as fp:
+            pickle.dump(self.trees, fp, protocol=4)
+
+    # Trees of the current project; loaded again when the project changes. Trees whose digest differs from the stamps file
+    # (the process ended before the trees were saved) are dropped and rebuilt on the next save signal
+    def _trees(self):
+        if bd.projects.current != self.project:
+            self.save()
+            self.project = bd.projects.current
+            self.directory = os.path.join(str(bd.projects.dir), "lineage")
+            os.makedirs(self.directory, exist_ok=True)
+            self.trees = {}
+            path = os.path.join(self.directory, TREES_FILE)
+            if os.path.exists(path):
+                with open(path, "rb") as fp:
+                    self.trees = pickle.load(fp)
+                stamps = {}
+                if os.path.exists(os.path.join(self.directory, STAMPS_FILE)):
+                    with open(os.path.join(self.directory, STAMPS_FILE)) as fp:
+                        stamps = json.load(fp)
+                self.trees = {database: tree for database, tree in self.trees.items() if stamps.get(database) == self.stamp_of(tree)}
+        return self.trees
+
+    @staticmethod
+    def stamp_of(tree):
+        if tree["stamp"] is None:
+            tree["stamp"] = hashlib.sha256(b"".join(b.to_bytes(16, "big") for b in tree["buckets"])).hexdigest()
+        return tree["stamp"]
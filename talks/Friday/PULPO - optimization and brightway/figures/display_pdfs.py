@@ -1,18 +1,64 @@
+import os
+import re
 import matplotlib.pyplot as plt
-from ipywidgets import interact
-from pdf2image import convert_from_path
-
-def show_figure(index):
-    pdf_path = 'figures/optimization_slideshow.pdf'
-    figures = convert_from_path(pdf_path, dpi=600)  # Set DPI to 300 for better quality
-    plt.figure(figsize=(8, 6))
-    plt.imshow(figures[index])
+from functools import lru_cache
+from ipywidgets import interact, fixed
+from pdf2image import convert_from_path, pdfinfo_from_path
+from PIL import Image
+
+PDF_PATH = 'figures/optimization_slideshow.pdf'
+CACHE_DIR = 'figures/.page_cache'  # Rasterized pages, reused across sessions
+DPI = 600  # Print quality, only used when passed as dpi
+FIGSIZE = (8, 6)
+
+def pdf_stamp(pdf_path):
+    # Changes whenever the PDF is replaced or edited, so cached pages of an older version are never shown
+    stat = os.stat(pdf_path)
+    return f'{stat.st_mtime_ns}-{stat.st_size}'
+
+def page_count(pdf_path=PDF_PATH):
+    # Read from the PDF metadata, nothing is rendered
+    return pdfinfo_from_path(pdf_path)['Pages']
+
+@lru_cache(maxsize=8)
+def display_dpi(pdf_path=PDF_PATH, stamp=None):
+    # Resolution at which the page width fills the figure width on screen (page size in points, 72 points per inch)
+    width = float(pdfinfo_from_path(pdf_path)['Page size'].split()[0]) / 72
+    return max(1, round(FIGSIZE[0] * plt.rcParams['figure.dpi'] / width))
+
+def prune_cache(pdf_path, stamp):
+    # Deletes the cached pages of older versions of the PDF
+    if not os.path.isdir(CACHE_DIR):
+        return
+    pattern = re.compile(re.escape(os.path.splitext(os.path.basename(pdf_path))[0]) + r'_(\d+-\d+)_\d+_\d+\.png')
+    for name in os.listdir(CACHE_DIR):
+        match = pattern.fullmatch(name)
+        if match and match.group(1) != stamp:
+            os.remove(os.path.join(CACHE_DIR, name))
+
+@lru_cache(maxsize=8)
+def load_page(pdf_path, stamp, dpi, index):
+    # Rasterizes only the requested page, once per PDF version and dpi; the last pages are kept in memory
+    # (8 pages at display resolution are a few MB, at DPI a few hundred MB, so DPI is only used when asked for)
+    cache_file = os.path.join(CACHE_DIR, f'{os.path.splitext(os.path.basename(pdf_path))[0]}_{stamp}_{dpi}_{index}.png')
+    if os.path.exists(cache_file):
+        with Image.open(cache_file) as image:
+            return image.copy()
+    image = convert_from_path(pdf_path, dpi=dpi, first_page=index + 1, last_page=index + 1)[0]
+    prune_cache(pdf_path, stamp)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    image.save(cache_file)
+    return image
+
+def show_figure(index, pdf_path=PDF_PATH, dpi=None):
+    # dpi=None renders at screen resolution (see display_dpi); e.g. dpi=DPI for print quality
+    stamp = pdf_stamp(pdf_path)
+    figure = load_page(pdf_path, stamp, dpi or display_dpi(pdf_path, stamp), index)
+    plt.figure(figsize=FIGSIZE)
+    plt.imshow(figure)
     plt.axis('off')
     plt.show()
 
-def show_all_figures():
-    # Convert PDF pages to images with higher DPI for better quality
-    pdf_path = 'figures/optimization_slideshow.pdf'
-    figures = convert_from_path(pdf_path, dpi=600)  # Set DPI to 300 for better quality
-    # Create a slider to interact with the figures
-    interact(show_figure, index=(0, len(figures) - 1))
\ No newline at end of file
+def show_all_figures(pdf_path=PDF_PATH, dpi=None):
+    # Create a slider to interact with the figures (dpi=None: screen resolution, much faster and enough for the slider)
+    interact(show_figure, index=(0, page_count(pdf_path) - 1), pdf_path=fixed(pdf_path), dpi=fixed(dpi))
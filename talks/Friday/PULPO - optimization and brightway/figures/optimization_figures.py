@@ -1,6 +1,9 @@
+import heapq
 import numpy as np
+import warnings
 import matplotlib.pyplot as plt
-from pyomo.environ import ConcreteModel, Var, Objective, Constraint, SolverFactory, NonNegativeReals, log, minimize, value
+from concurrent.futures import ProcessPoolExecutor
+from pyomo.environ import ConcreteModel, Var, Param, Expression, Objective, Constraint, SolverFactory, NonNegativeReals, log, minimize, value
 
 # Constants
 T_h_in = 150  # °C, Inlet temperature of hot stream
@@ -31,54 +34,144 @@ def define_constraints(model):
     model.EnergyBalanceCold = Constraint(expr=model.Q == C_c * (model.T_c_out - T_c_in))
     model.LMTD = Constraint(expr=model.Q == U * model.A * ((T_h_in - model.T_c_out) - (model.T_h_out - T_c_in)) / log((T_h_in - model.T_c_out) / (model.T_h_out - T_c_in)))
 
-def solve_pareto_front(steps=50):
-    costs = []
-    emissions = []
-    weights = np.linspace(0, 1, steps)
-
-    for w in weights:
-        model = ConcreteModel()
-
-        # Define variables and constraints
-        define_variables(model)
-        define_constraints(model)
-
-        # Define weighted objective
-        def weighted_objective_rule(model):
-            # Economic Objective: Total Cost
-            cost_utilities = C_h * (model.T_h_out - T_h_out_target) * C_hot + C_c * (T_c_out_target - model.T_c_out) * C_cold
-            cost_HX = C_A * (model.A) ** n
-            total_cost = cost_utilities + cost_HX
-
-            # Environmental Objective: Total Emissions
-            emissions_utilities = EF_hot * C_h * (model.T_h_out - T_h_out_target) + EF_cold * C_c * (T_c_out_target - model.T_c_out)
-            emissions_HX = EF_A * model.A
-            total_emissions = emissions_utilities + emissions_HX
-
-            # Weighted sum of both objectives
-            return w * total_cost + (1 - w) * total_emissions
-
-        model.WeightedObjective = Objective(rule=weighted_objective_rule, sense=minimize)
-
-        # Solve the model
-        solver = SolverFactory('ipopt')
-        result = solver.solve(model, tee=False)
-
-        if result.solver.termination_condition == 'optimal':
-            # Calculate cost and emissions after solving
-            cost_utilities = value(C_h * (model.T_h_out - T_h_out_target) * C_hot + C_c * (T_c_out_target - model.T_c_out) * C_cold)
-            cost_HX = value(C_A * (model.A) ** n)
-            total_cost = cost_utilities + cost_HX
-
-            emissions_utilities = value(EF_hot * C_h * (model.T_h_out - T_h_out_target) + EF_cold * C_c * (T_c_out_target - model.T_c_out))
-            emissions_HX = value(EF_A * model.A)
-            total_emissions = emissions_utilities + emissions_HX
-
-            # Store the objectives for the Pareto front
-            costs.append(total_cost)
-            emissions.append(total_emissions)
-
-    return np.array(costs), np.array(emissions)
+def define_objectives(model):
+    # Mutable parameters: weight of the cost objective and emission cap (epsilon-constraint mode)
+    model.w = Param(initialize=0.5, mutable=True)
+    model.eps = Param(initialize=1e12, mutable=True)
+
+    # Economic Objective: Total Cost
+    cost_utilities = C_h * (model.T_h_out - T_h_out_target) * C_hot + C_c * (T_c_out_target - model.T_c_out) * C_cold
+    cost_HX = C_A * (model.A) ** n
+    model.TotalCost = Expression(expr=cost_utilities + cost_HX)
+
+    # Environmental Objective: Total Emissions
+    emissions_utilities = EF_hot * C_h * (model.T_h_out - T_h_out_target) + EF_cold * C_c * (T_c_out_target - model.T_c_out)
+    emissions_HX = EF_A * model.A
+    model.TotalEmissions = Expression(expr=emissions_utilities + emissions_HX)
+
+    # Weighted sum of both objectives, or minimum cost below the emission cap
+    model.WeightedObjective = Objective(expr=model.w * model.TotalCost + (1 - model.w) * model.TotalEmissions, sense=minimize)
+    model.CostObjective = Objective(expr=model.TotalCost, sense=minimize)
+    model.EmissionCap = Constraint(expr=model.TotalEmissions <= model.eps)
+
+def build_model(mode='weighted'):
+    model = ConcreteModel()
+
+    # Define variables, constraints and objectives
+    define_variables(model)
+    define_constraints(model)
+    define_objectives(model)
+
+    # Select the objective of the sweep mode
+    if mode == 'weighted':
+        model.CostObjective.deactivate()
+        model.EmissionCap.deactivate()
+    elif mode == 'epsilon':
+        model.WeightedObjective.deactivate()
+    else:
+        raise ValueError(f"Unknown mode '{mode}', use 'weighted' or 'epsilon'")
+    return model
+
+def solve_sweep(parameters, mode='weighted'):
+    # The model is built once; only the mutable parameter changes between solves (weights in 'weighted' mode, emission caps in
+    # 'epsilon' mode) and each solve starts from the previous solution, which stays in the variables (warm start)
+    model = build_model(mode)
+    parameter = model.w if mode == 'weighted' else model.eps
+    solver = SolverFactory('ipopt')
+
+    return [solve_point(model, solver, parameter, p) for p in parameters]
+
+def solve_point(model, solver, parameter, p):
+    parameter.set_value(float(p))
+    result = solver.solve(model, tee=False)
+
+    if result.solver.termination_condition == 'optimal':
+        return (value(model.TotalCost), value(model.TotalEmissions))
+    return None
+
+def solve_adaptive(tolerance=0.02, max_solves=200, cache=None):
+    # Starts from the two anchor points (weight 1: minimum cost, weight 0: minimum emissions) and bisects only the weight intervals
+    # whose points are further apart than 'tolerance' in objective space (both objectives scaled by the anchor ranges), the largest gap first.
+    # 'cache' ({weight: (cost, emissions)}) keeps every solved weight, so it can be passed again e.g. with a smaller tolerance
+    cache = {} if cache is None else cache
+    model = build_model()
+    solver = SolverFactory('ipopt')
+    variables = list(model.component_data_objects(Var))
+    states = {}  # Variable values of the weights solved in this call, used to warm-start their neighbours
+
+    def solve(w, start=()):
+        if w not in cache:
+            for state in start:
+                if state in states:
+                    for variable, x in zip(variables, states[state]):
+                        variable.value = x
+                    break
+            cache[w] = solve_point(model, solver, model.w, w)
+            states[w] = [variable.value for variable in variables]
+        return cache[w]
+
+    min_cost, min_emissions = solve(1.0), solve(0.0)
+    if min_cost is None or min_emissions is None:
+        return cache
+    scale = (abs(min_emissions[0] - min_cost[0]) or 1.0, abs(min_cost[1] - min_emissions[1]) or 1.0)
+
+    # Heap of the intervals still too coarse, keyed by their scaled gap (largest first)
+    intervals = []
+
+    def push(a, b):
+        point_a, point_b = cache[a], cache[b]
+        if point_a is None or point_b is None:
+            return
+        gap = np.hypot((point_a[0] - point_b[0]) / scale[0], (point_a[1] - point_b[1]) / scale[1])
+        if gap > tolerance and b - a > 1e-6:
+            heapq.heappush(intervals, (-gap, a, b))
+
+    push(0.0, 1.0)
+    unrefined = []  # Intervals without an optimal solution inside (kept as gaps of the front)
+    while intervals and len(cache) < max_solves:
+        _, a, b = heapq.heappop(intervals)
+        # Warm start from an end point of the interval (the closest solved weights); when the solver fails at the midpoint,
+        # nearby weights are tried before the interval is given up
+        for fraction in (0.5, 0.25, 0.75):
+            middle = a + (b - a) * fraction
+            if solve(middle, (a, b)) is not None:
+                push(a, middle)
+                push(middle, b)
+                break
+        else:
+            unrefined.append((a, b))
+    if unrefined:
+        warnings.warn(f'No optimal solution found inside the weight intervals {unrefined}: these gaps of the Pareto front are not refined')
+    return cache
+
+def solve_pareto_front(steps=50, mode='weighted', workers=1, tolerance=0.02, cache=None):
+    # 'weighted': weights evenly spaced in [0, 1]; 'epsilon': emission caps evenly spaced between the two anchor points
+    # (minimum emissions and minimum cost), which gives evenly spaced points on the front;
+    # 'adaptive': bisection of the weights until neighbouring points are closer than 'tolerance' (at most 'steps' solves, see solve_adaptive)
+    if mode == 'weighted':
+        parameters = np.linspace(0, 1, steps)
+    elif mode == 'adaptive':
+        cache = solve_adaptive(tolerance, steps, cache)
+        points = [cache[w] for w in sorted(cache) if cache[w] is not None]
+        return np.array([cost for cost, _ in points]), np.array([emission for _, emission in points])
+    elif mode == 'epsilon':
+        anchors = [point for point in solve_sweep([0.0, 1.0]) if point is not None]
+        parameters = np.linspace(min(e for _, e in anchors), max(e for _, e in anchors), steps)
+    else:
+        raise ValueError(f"Unknown mode '{mode}', use 'weighted', 'epsilon' or 'adaptive'")
+
+    # Contiguous chunks per process, so that warm starts stay close to the next solution
+    if workers > 1:
+        chunks = np.array_split(parameters, workers)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = [point for points in executor.map(solve_sweep, chunks, [mode] * len(chunks)) for point in points]
+    else:
+        results = solve_sweep(parameters, mode)
+
+    # Store the objectives of the optimal solutions for the Pareto front
+    costs = np.array([cost for cost, _ in filter(None, results)])
+    emissions = np.array([emission for _, emission in filter(None, results)])
+    return costs, emissions
 
 def plot_pareto_front(costs, emissions):
     # Set a fixed white background for the plot
@@ -9,51 +9,102 @@ Created on Wed Oct  9 08:47:41 2019
 @author: yamamototm
 """
 
+import hashlib
 import json
+import numpy as np
 import pandas as pd
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from fuzzywuzzy import fuzz
 from fuzzywuzzy import process
+from fuzzywuzzy import utils
+try:
+    from rapidfuzz import fuzz as rf_fuzz #compiled scorer, optional (see EXACT_SCORES)
+    from rapidfuzz import process as rf_process
+except ImportError:
+    rf_process = None
 
 # Get the directory where the script is located and set the current working directory to the script's directory
 script_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
 os.chdir(script_dir)
 
 #Const
-file_name = 'plastics'
-db_name = 'ecoinvent-3.10-cutoff'
+FILE_NAMES = ['plastics', 'metals', 'rubbers'] #material groups (<file_name>.xlsx)
+DB_NAMES = ['apos36', 'conseq36', 'cutoff36', 'ecoinvent-3.10-cutoff'] #releases (activity catalogs <db_name>.npy, see db_to_catalog in the PMC ecoinvent script, or <db_name>.csv activity lists)
+MANIFEST = 'mat_dict_gen.json' #content hashes of the inputs of every generated dictionary; unchanged dictionaries are skipped
+WORKERS = None #number of processes (None: one per CPU)
 LIMIT_SCORE = 100
 PET_CORRECT = True
-
-#reading
-ei = pd.read_csv(db_name+'.csv', sep='|', encoding="cp1252")
-material_group = pd.read_excel(file_name+'.xlsx')
-
-def checker(wrong_options, correct_options):
+PREFILTER = 'market' #only activities with this word in their name are scored (only markets are kept in the dictionary)
+EXACT_SCORES = False #True: scores below 100 are computed with fuzzywuzzy exactly as before; False: with the compiled rapidfuzz scorer if installed (these rows are dropped by LIMIT_SCORE = 100 anyway)
+LONG_NAME = 200 #from this length on the SequenceMatcher behind fuzz.partial_ratio junks frequent characters, so such names are always scored in full
+
+#For each name in 'wrong_options' returns the best matching name from 'correct_options' and its fuzz.partial_ratio score (as process.extractOne does).
+#Names without PREFILTER are not scored (returned as '' with score 0). A score of 100 means that the shorter (processed) name
+#is contained in the longer one, so these matches are found with plain substring checks, comparing only the pairs that share
+#the first trigram of the material name (blocking). Only names without such a match are scored pair by pair (see EXACT_SCORES).
+def checker(wrong_options, correct_options, prefilter=PREFILTER, exact_scores=EXACT_SCORES, file_name='', verbose=True):
+    options = [utils.full_process(option) for option in correct_options]
+    lengths = np.array([len(option) for option in options])
+    blocks = {} #first trigram of each material name -> material indices
+    short = [] #material names too short for a trigram
+    for j, option in enumerate(options):
+        if len(option) < 3:
+            short.append(j)
+        else:
+            blocks.setdefault(option[:3], []).append(j)
+    scored = {} #processed name -> (material index, score); ecoinvent repeats names for every location
     names_array = []
     ratio_array = []    
     i = 0
     prt = -1
     for wrong_option in wrong_options:
-        #if wrong_option in correct_options:
-         #  names_array.append(wrong_option)
-          # ratio_array.append(100)
-        #else:   
             # update the bar
             i += 1
             pr = int(100*i/len(wrong_options))
-            if  (pr != prt):
+            if  verbose and (pr != prt):
                 b = "\rScanning for the appropriate activities in " + file_name + ": " + str(pr) + "%"
                 print (b, end="\r")
                 prt = pr
-                
-            x = process.extractOne(wrong_option, correct_options, scorer = fuzz.partial_ratio)
-            names_array.append(x[0])
-            ratio_array.append(x[1])
+
+            if prefilter and prefilter not in wrong_option:
+                names_array.append('')
+                ratio_array.append(0)
+                continue
+            name = utils.full_process(wrong_option)
+            if name not in scored:
+                scored[name] = substring_match(name, options, lengths, blocks, short)
+                if scored[name] is None:
+                    scored[name] = best_match(wrong_option, name, correct_options, options, exact_scores)
+            j, score = scored[name]
+            names_array.append(correct_options[j])
+            ratio_array.append(score)
             
     return names_array, ratio_array
 
+#Returns (index, 100) of the first material name in 'options' that is contained in 'name' (or contains it), None if there is none
+def substring_match(name, options, lengths, blocks, short):
+    if not name:
+        return None
+    candidates = set(short)
+    for k in range(len(name) - 2):
+        candidates.update(blocks.get(name[k:k+3], ()))
+    candidates.update(np.flatnonzero(lengths > len(name)).tolist())
+    for j in sorted(candidates):
+        option = options[j]
+        if option and max(len(option), len(name)) < LONG_NAME and ((option in name) if len(option) <= len(name) else (name in option)):
+            return j, 100
+    return None
+
+#Scores 'name' against all material names pair by pair: fuzzywuzzy (identical to before) or the compiled rapidfuzz scorer
+def best_match(wrong_option, name, correct_options, options, exact_scores):
+    if not exact_scores and rf_process is not None and name:
+        x = rf_process.extractOne(name, options, scorer=rf_fuzz.partial_ratio, processor=None)
+        return x[2], int(round(x[1]))
+    x = process.extractOne(wrong_option, correct_options, scorer = fuzz.partial_ratio)
+    return correct_options.index(x[0]), x[1]
+
 #correct for PET as they classified as PE:
 def PET_correct(df):
     df1 = df[df['plastic_name']=='polyethylene'].reset_index(drop=True)
@@ -68,36 +119,37 @@ def PET_correct(df):
     df1['plastic_name'] = pd.Series(names_array)
     return pd.concat((df1,df2), axis=0)
 
-strOptions = material_group['Name'].tolist()
-str2Match = ei['name'].tolist()
-
-name_match, ratio_match = checker(str2Match, strOptions)
+#Generates the material dictionary {Symbol: ((db_name, key), ...)} of the material group 'material_group' (table from <file_name>.xlsx)
+# for the activity list 'ei' (see load_activities)
+def material_dict(ei, material_group, db_name, file_name, verbose=True):
+    strOptions = material_group['Name'].tolist()
+    str2Match = ei['name'].tolist()
 
-df = pd.DataFrame()
-df['ei_name'] = pd.Series(str2Match)
-df['plastic_name'] = pd.Series(name_match)
-df['correct_ratio'] = pd.Series(ratio_match)
-df['key'] = ei['key']
+    name_match, ratio_match = checker(str2Match, strOptions, file_name=file_name, verbose=verbose)
 
-#select markets
-df = df[df["ei_name"].str.contains('market')]
+    df = pd.DataFrame()
+    df['ei_name'] = pd.Series(str2Match)
+    df['plastic_name'] = pd.Series(name_match)
+    df['correct_ratio'] = pd.Series(ratio_match)
+    df['key'] = ei['key']
 
-#filter our unrelated activities
-df = df[df['correct_ratio'] == LIMIT_SCORE][['ei_name','plastic_name','key']]
-df = df[df['ei_name'] != 't'] #remove this activity
+    #select markets
+    df = df[df["ei_name"].str.contains('market')]
 
-if PET_CORRECT:
-    df = PET_correct(df)
+    #filter our unrelated activities
+    df = df[df['correct_ratio'] == LIMIT_SCORE][['ei_name','plastic_name','key']]
+    df = df[df['ei_name'] != 't'] #remove this activity
 
-df_t = df
-#get the symbol
-df = pd.merge(df, material_group, how='inner', left_on='plastic_name', right_on='Name')
-df = df[['key','Symbol']]
+    if PET_CORRECT:
+        df = PET_correct(df)
 
-df['db'] = db_name
+    #get the symbol
+    df = pd.merge(df, material_group, how='inner', left_on='plastic_name', right_on='Name')
+    df = df[['key','Symbol']]
 
-df_dict = df.groupby('Symbol')[['db','key']].apply(lambda g: tuple(map(tuple, g.values.tolist()))).to_dict()
+    df['db'] = db_name
 
+    return df.groupby('Symbol')[['db','key']].apply(lambda g: tuple(map(tuple, g.values.tolist()))).to_dict()
 
 # dictionary in the end        
         
@@ -107,11 +159,61 @@ df_dict = df.groupby('Symbol')[['db','key']].apply(lambda g: tuple(map(tuple, g.
 # remove markets
 # generate the dictionary
 
-#save dict. to JSON file
-with open(file_name+'_dict_'+db_name+'_m.json', 'w') as fp:
-    json.dump(df_dict, fp)
-
-
-
-
-
+#Activity list file of the release 'db_name': the catalog <db_name>.npy if there is one, otherwise the <db_name>.csv export
+def activity_file(db_name):
+    return db_name+'.npy' if os.path.exists(db_name+'.npy') else db_name+'.csv'
+
+#Loads the activity list of the release 'db_name' (columns 'name' and 'key'); catalogs are opened memory-mapped (zero-copy)
+def load_activities(db_name):
+    if activity_file(db_name).endswith('.npy'):
+        return np.load(db_name+'.npy', mmap_mode='r')
+    return pd.read_csv(db_name+'.csv', sep='|', encoding="cp1252")
+
+#Name of the JSON file with the material dictionary of the material group 'file_name' for the release 'db_name'
+def dict_file(file_name, db_name):
+    return file_name+'_dict_'+db_name+'_m.json'
+
+#Content hash of the given files plus this script and its settings: a dictionary only has to be regenerated when this hash changes
+def content_hash(*paths):
+    h = hashlib.sha256(repr((LIMIT_SCORE, PET_CORRECT, PREFILTER, EXACT_SCORES, LONG_NAME)).encode())
+    for path in (os.path.abspath(__file__),) + paths:
+        with open(path, 'rb') as fp:
+            h.update(hashlib.sha256(fp.read()).digest())
+    return h.hexdigest()
+
+#Runs in a worker process: generates and saves one material dictionary ('ei' is None for catalogs: each worker maps the file itself)
+def generate(ei, material_group, db_name, file_name):
+    if ei is None:
+        ei = load_activities(db_name)
+    df_dict = material_dict(ei, material_group, db_name, file_name, verbose=False)
+    #save dict. to JSON file
+    with open(dict_file(file_name, db_name), 'w') as fp:
+        json.dump(df_dict, fp)
+    return dict_file(file_name, db_name)
+
+#Generates the dictionaries of all material groups in 'file_names' for all releases in 'db_names' in one go:
+# outputs whose inputs did not change since the last run are skipped, every activity list and material table
+# is read only once, and the dictionaries are generated in parallel processes
+def generate_all(file_names=FILE_NAMES, db_names=DB_NAMES, workers=WORKERS):
+    manifest = {}
+    if os.path.exists(MANIFEST):
+        with open(MANIFEST, 'r') as fp:
+            manifest = json.load(fp)
+    hashes = {(file_name, db_name): content_hash(activity_file(db_name), file_name+'.xlsx') for db_name in db_names for file_name in file_names}
+    todo = [item for item, digest in hashes.items() if manifest.get(dict_file(*item)) != digest or not os.path.exists(dict_file(*item))]
+    print(f'{len(hashes) - len(todo)} of {len(hashes)} material dictionaries are up to date')
+    if not todo:
+        return []
+    activities = {db_name: None if activity_file(db_name).endswith('.npy') else load_activities(db_name) for db_name in {db_name for _, db_name in todo}}
+    groups = {file_name: pd.read_excel(file_name+'.xlsx') for file_name in {file_name for file_name, _ in todo}}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(generate, activities[db_name], groups[file_name], db_name, file_name): (file_name, db_name) for file_name, db_name in todo}
+        for future, item in futures.items():
+            print(future.result(), 'saved')
+            manifest[dict_file(*item)] = hashes[item]
+            with open(MANIFEST, 'w') as fp:
+                json.dump(manifest, fp, indent=4)
+    return [dict_file(*item) for item in todo]
+
+if __name__ == '__main__':
+    generate_all()
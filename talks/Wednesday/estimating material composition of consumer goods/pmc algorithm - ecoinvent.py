@@ -25,8 +25,10 @@ Created on Thu Aug 22 18:01:26 2019
 
 #IMPORTS:
 from brightway2 import *
-from functools import cmp_to_key
 import brightway2 as bw
+import numpy as np
+import pandas as pd
+import pmc_functions as pmc
 import json
 import csv
 import sys
@@ -50,19 +52,32 @@ METHOD_KEY = ('ReCiPe 2016 v1.03, endpoint (H)', 'natural resources', 'material
 BIO_MAT_LIST = ["Copper", "Aluminium", "Tantalum"] #the natural materials of interest (the appropariate flows in the biospere database will be selected later on based on this names). Each name should start with the capital letter (see conventional names of materials/metals in the biosphere3 database)
 FU = 1 #amount of the functional unit
 FILE_OUT = 'output.txt'
-KEY_index = 1 #index of the actual activity/bioflow key in a conventional tuple key like (db, key)
 DB_NAME = 'ecoinvent-3.10-cutoff' #'consequential310'
+OVERLAY_FILE = DB_NAME + '_overlays.npz' #scaled exchange amounts of the incorporation scenarios (see inc_overlays)
+BATCH = False #True: MF and MC of all products in prod_list at once with a single factorization of the unfiltered and of the filtered technosphere (see pmc.batch_composition)
+BATCH_OUT = 'output_batch.csv' #tidy table with the results of the batch mode
+MC_ITERATIONS = 0 #>0: Monte Carlo uncertainty bands of the batch results with this many iterations (see pmc.monte_carlo)
+MC_WORKERS = 1 #processes of the Monte Carlo mode; this script has no main guard, so >1 only where worker processes are forked (Linux before Python 3.14), not spawned (Windows, macOS, Spyder)
+MC_OUT = 'output_monte_carlo.csv' #tidy table with the percentile bands of the Monte Carlo mode
+PATHS_TOP = 0 #>0: list this many top supply-chain paths to the markets of each material after the MC of each product (see pmc.contribution_paths)
+TRAVERSE_CUTOFF = None #e.g. 1e-4: quick screening of the MC with a supply-chain traversal instead of a full solve (see pmc.traverse_composition)
+INC_FILE = DB_NAME + '_inc.npy' #sidecar array with the material incorporation parameters of all exchanges in DB_NAME (see db_inc_filter)
 
 #PREPARATIONS:
 #bw2setup() #set up the Brightway2 environment (if not already set up)
 #assumed that you already have default bw env and ecoinvent database that is called 'consequential310' - change if needed
 projects.set_current("default")
 db  = bw.Database(DB_NAME)
-bio = bw.Database('biosphere3')
 
 #DEFINE AVOID LISTS
 avoid_activities = ["treatment", "water", "waste", "container", "box", "packaging", "foam", "electricity", "factory", "adapter", "oxidation", "construction", "heat", "facility", "gas", "freight", "mine", "infrastructure", "conveyor", "road", "building", "used", "maintenance", "transport", "moulding", "mold", "wastewater", "steam", "scrap", "converter"]
     
+#alternative avoid lists, compared side by side in the batch mode (see inc_variants_compare); the first one is the reference
+avoid_variants = [avoid_activities, [word for word in avoid_activities if word not in ("box", "container", "foam")]]
+
+#uncertain keywords of the Monte Carlo mode: probability that the keyword really marks inputs that are not incorporated in the product
+avoid_uncertain = {"box": 0.5, "container": 0.5, "foam": 0.5}
+    
 #MATERIAL SELECTION
 #hint: use markets instead of production activities as they conveniently include all the regional prod. activities and there's no need to list them separately
 materials_dict_cutoff310 = {
@@ -80,151 +95,109 @@ combined_plastics = [item for sublist in materials_dict_cutoff310["Plastics"].va
 materials_dict_cutoff310["Plastics"] = {"Total": combined_plastics}
 
 #FUNCTIONS:
-def activity_by_name(name, db): #return first activity dataset based on name keyword
-    candidates = [x for x in db if name in x['name']]
-    candidates = sorted(candidates, key=cmp_to_key(lambda item1, item2: len(item1['name']) - len(item2['name'])))  #shortest name is the best match
-    with open(FILE_OUT, 'a') as f:
-        print('\n', candidates[0], ' from ', db.name, file=f)
-    return candidates[0]
-
-def activity_by_key(key, db): # key = tuple(db, key) -> activity (dataset) in db
-    return db.get(key[1])
+def activity_by_name(name, db): #return first activity dataset based on name keyword; shortest name is the best match (see the persistent name index in pmc.name_index)
+    return pmc.activity_by_name(name, db)
 
 #List all intermediate (technosphere) flows (activities) in the resulting supply-array (see the Paper) that is stored in the reuslting 'lca' object
-def list_techno_inventory(lca):
+# (only the non-zero ones above 'threshold', largest first, named from a cached index; 'path' (.csv/.parquet) writes the whole technosphere matrix as well)
+def list_techno_inventory(lca, threshold=0.0, path=None):
     print("\u25A0 Supply array: ")
-    for k in lca.activity_dict:
-        print(activity_by_key(k, db)["name"], ": ", lca.supply_array[lca.activity_dict[k]])
+    for name, amount in pmc.supply_table(lca, threshold)[['name', 'amount']].itertuples(index=False):
+        print(name, ": ", amount)
+    if path is not None:
+        pmc.export_technosphere(lca, path, threshold)
     print()
 
 #For the product of interest from the database 'db' list incorporation parameters for all inputs of its production process
+# (read from the incorporation vector aligned with lca.tech_params, see lca_inc, so the parameter does not have to be stored in the database)
 def product_inputs(prod, db):
     act = activity_by_name(prod, db)
-    for exc in act.technosphere():
-        try:
-            print(bw.get_activity(exc["input"])._document.product, exc['incorporated'])
-        except: 
-            print('Error: Not all of the exchanges in your LCI database have the incorporation parameter assigned!')
-            sys.exit(1) 
-
-#Resets inc. parameter in the original db (~30 min)
-def db_inc_filter(db, avoid_activities):
-    i = 0
-    prt = -1
-    for act in db:
-        # update the bar
-        i += 1
-        pr = int(100*i/len(db))
-        if  (pr != prt):
-            b = "\rAssigning material incorporation parameters to all exchanges in the " + db.name + " database: " + str(pr) + "%"
-            print (b, end="\r")
-            prt = pr
-        for exc in act.technosphere():
-            avoid = False
-            in_act = bw.get_activity(exc["input"])
-            exc_name = in_act._document.product #product name; same as exc["name"] but works for manual db
-            for word in avoid_activities:
-                if word in exc_name: #name of the product of the exchange
-                    avoid = True
-                    break
-            exc['incorporated'] = 0.0 if avoid else 1.0
-            exc.save()
-    print('\n')
+    lca = LCA_load(db)
+    inc = lca_inc(db, lca)
+    params = lca.tech_params
+    products = pmc.row_products(lca)
+    for i in np.flatnonzero((params['col'] == lca.activity_dict[act.key]) & (params['type'] == pmc.TECHNOSPHERE)):
+        print(products[params['row'][i]], inc[i])
 
-#Restores all the incorporation parameters in the database back to 1
-def db_inc_reset(db): 
-    i = 0
-    prt = -1
-    for act in db:
-        # update the bar
-        i += 1
-        pr = int(100*i/len(db))
-        if  (pr != prt):
-            b = "\rApplying full (1.0) incorporation parameters to the activities: " + str(pr) + "%"
-            print (b, end="\r")
-            prt = pr
-        for exc in act.technosphere():
-            exc['incorporated'] = 1.0
-            exc.save()
-    print('\n')  
+#Assigns material incorporation parameters (0 or 1) to all technosphere exchanges of the 'db' database based on the list of keywords in 'avoid_activities' (a few seconds)
+# the parameters are kept in the sidecar array INC_FILE; the database itself is only edited if write=True (slow, see pmc.db_inc_write)
+def db_inc_filter(db, avoid_activities, write=False):
+    lca = LCA_load(db)
+    inc = pmc.inc_vector(lca, avoid_activities)
+    pmc.inc_save(lca, inc, INC_FILE)
+    print(f'Non-incorporated exchanges in the {db.name} database: {int((inc < 1).sum())} of {int((lca.tech_params["type"] == pmc.TECHNOSPHERE).sum())}')
+    if write:
+        pmc.db_inc_write(db, lca, inc)
+    return inc
+
+#Restores all the incorporation parameters back to 1 (in the sidecar array INC_FILE and, if write=True, in the database 'db')
+def db_inc_reset(db, write=False):
+    lca = LCA_load(db)
+    inc = np.ones(len(lca.tech_params))
+    pmc.inc_save(lca, inc, INC_FILE)
+    if write:
+        pmc.db_inc_write(db, lca, inc)
+    return inc
             
-#Edits lca techn. matrix (exclude non-incorporative exc) based on incorporation parameter in the db database
-def lca_exclude_noninc(db, lca): 
-    i = 0
-    prt = -1
-    print('\n')
-    for act in db:
-        # update the bar
-        i += 1
-        pr = int(100*i/len(db))
-        if  (pr != prt):
-            b = "\rExcluding the non-incorporated materials from the technosphere matrix: " + str(pr) + "%"
-            print (b, end="\r")
-            prt = pr
-        for exc in act.technosphere():
-            try:
-                inc = exc['incorporated']
-            except:
-                inc = 1 #if the incorporation parameter was not entered in ab or set by db_inc_filter() previously
-                print('Error: missing incorporation parameter in the LCI database detected! -> assigned to 1')
-            if  inc < 1:
-                row = lca.activity_dict[exc["input"]]
-                col = lca.activity_dict[act.key]
-                lca.technosphere_matrix[row, col] *= inc
-    return lca
+#Returns the incorporation parameters of all exchanges in 'lca' (aligned with lca.tech_params):
+# from the sidecar array INC_FILE (see db_inc_filter) or, if there is none, from the 'db' database
+def lca_inc(db, lca):
+    return pmc.inc_load(lca, INC_FILE) if os.path.exists(INC_FILE) else pmc.inc_from_db(db, lca)
 
 #Creates an LCA object based on the reference product 'act' in the database 'db' and the bioflow 'material_bioflow' of interest     
 def LCA_create(act, FU): 
     functional_unit = {act: FU}
     return bw.LCA(functional_unit, METHOD_KEY)
 
+#Creates an LCA object with the technosphere and biosphere matrices of the whole database 'db' loaded (nothing is solved)
+def LCA_load(db):
+    lca = bw.LCA({db.random(): 1})
+    lca.load_lci_data()
+    return lca
+
 #'prod' is passed for a proper relative weight calculation
 def materials_inv(mat_list, lca, prod): 
-    for flow_index, amount in enumerate(lca.inventory.sum(axis=1).flat): # lca.inventory.sum(axis=1).flat gives you the summed inventory for each biosphere flow
-        flow_key = list(lca.biosphere_dict.items())[flow_index][0][KEY_index] #obtain key of each bioflow (in the resulting 'inventory') based on the 'biosphere_dict' that lists the keys of the resulting elementary flows 
-        flow_name = bio.get(flow_key)['name'] #obtain name of each bioflow using its key based on the 'bio' database that contains the names of all elementary flows
-        if flow_name in mat_list:
-            print(f'{flow_name}: {round(amount, FLOAT_RND)} kg OR {round(amount/prod_wght[prod_list.index(prod)] * 100, FLOAT_RND)} %')  
+    flows = pmc.biosphere_flows(lca) #cached table with key, name and categories of each bioflow (row of the 'inventory')
+    rows = pmc.material_rows(lca, mat_list) #rows of the bioflows named in 'mat_list' (resolved once)
+    amounts = np.asarray(lca.inventory.sum(axis=1)).ravel()[rows] # lca.inventory.sum(axis=1) gives you the summed inventory for each biosphere flow
+    for flow_name, amount in zip(flows['name'].to_numpy()[rows], amounts):
+        print(f'{flow_name}: {round(amount, FLOAT_RND)} kg OR {round(amount/prod_wght[prod_list.index(prod)] * 100, FLOAT_RND)} %')  
     print('\n')
     return 0
 
-#Given predefined 'materials_dict' (see above), aggregates and prints 
+#Given predefined 'materials_dict' (see above) compiled with pmc.compile_materials() into 'materials', aggregates and prints 
 # resulting material fllows (MC or MF of a product, depending if filtering was applied) 
 # using the 'supply_array' from the resulting 'lca' object
-def materials_sup(materials_dict, lca, prod):
-    try:
-        for material_group in materials_dict:
-            gr_sum = 0
-            for material in materials_dict[material_group]:
-                mat_sum = 0
-                for act_key in materials_dict[material_group][material]:
-                    act_key = tuple(act_key) #this fix to is needed as the keys from the fp file are given as a list [db_name,key]
-                    mat_sum += lca.supply_array[lca.activity_dict[act_key]]
-                print(material, " : ", round(mat_sum, FLOAT_RND), ' kg')
-                gr_sum += mat_sum
-            print(f'> {material_group} total : {round(gr_sum, FLOAT_RND)} kg OR {round(gr_sum/prod_wght[prod_list.index(prod)] * 100, FLOAT_RND)} %')
-    except Exception as e: 
-        print(f'\nError: most likely you used a wrong key in your material dictionary that does not properly link to the activity in the LCI database! \nCheck the {e}')
-        sys.exit(1) 
+def materials_sup(materials, lca, prod):
+    amounts, totals = pmc.material_amounts(materials, lca.supply_array)
+    for group_index, material_group in enumerate(materials['groups']):
+        for material_index in np.sort(materials['rollup'][group_index].indices):
+            print(materials['materials'][material_index][1], " : ", round(amounts[material_index], FLOAT_RND), ' kg')
+        gr_sum = totals[group_index]
+        print(f'> {material_group} total : {round(gr_sum, FLOAT_RND)} kg OR {round(gr_sum/prod_wght[prod_list.index(prod)] * 100, FLOAT_RND)} %')
     return 0
 
-def db_amount_save(db): #save all the original amounts of the exchanges
-    for act in db:
-        for exc in act.technosphere():
-            exc['amount_save'] = exc['amount']
-            exc.save()
-            
-def db_amount_restore(db): #restore all the original amounts of the exchanges
-    for act in db:
-        for exc in act.technosphere():
-            exc['amount'] = exc['amount_save']
-            exc.save()
-            
-def db_inc_to_amounts(db): #adjust all the amounts of the exchanges based on the incorporation
-    for act in db:
-        for exc in act.technosphere():
-            exc['amount'] = exc['amount_save'] * exc['incorporated']
-            exc.save()    
+#Incorporation scenarios without editing the database: for each named incorporation vector in 'scenarios' ({name: inc}, aligned with lca.tech_params)
+# an overlay of scaled exchange amounts is kept next to the original amounts and all of them are saved side by side into OVERLAY_FILE
+def inc_overlays(lca, scenarios):
+    overlays = {name: pmc.amount_overlay(lca, inc) for name, inc in scenarios.items()}
+    pmc.overlays_save(lca, overlays, OVERLAY_FILE)
+    return overlays
+
+#Switches the technosphere matrix of 'lca' to one of the overlays (None = original amounts); replaces editing and restoring the amounts in the database
+def lca_overlay(lca, overlay=None):
+    return pmc.apply_overlay(lca, overlay)
+
+#MC of each material group for the products in 'acts' under each keyword list in 'variants' (alternative avoid lists): one column per variant.
+# All variants are solved together: the first filtered technosphere is factorized, the others reuse it where they differ little (see pmc.variant_supplies)
+def inc_variants_compare(lca, acts, variants, materials):
+    supply = pmc.variant_supplies(lca, pmc.inc_variants(lca, variants), pmc.demand_matrix(lca, acts, FU))
+    totals = np.stack([pmc.material_amounts(materials, supply[:, :, k])[1] for k in range(len(variants))], axis=-1) #groups x products x variants
+    index = pd.MultiIndex.from_product([[act['name'] for act in acts], materials['groups']], names=['product', 'group'])
+    return pd.DataFrame(totals.transpose(1, 0, 2).reshape(-1, len(variants)), index=index, columns=[f'variant {k}' for k in range(len(variants))])
+
+def db_to_catalog(db): #save datasets (name, key, reference product, location, unit, classification) into the memory-mappable catalog dict_gen/<db name>.npy read by dict_gen/mat_dict_gen.py; redone only if the database changed
+    return pmc.db_to_catalog(db, os.path.join('dict_gen', db.name + '.npy'))
 
 def db_to_csv(db): #save datasets (name, key) into the csv file
     #generate a list of act. names and their keys
@@ -244,29 +217,68 @@ def db_to_csv(db): #save datasets (name, key) into the csv file
 
 print(combined_plastics)
 
+#log the activities selected for the products of interest
+with open(FILE_OUT, 'a') as f:
+    for prod in prod_list:
+        print('\n', activity_by_name(prod, db), ' from ', db.name, file=f)
+
 #lists description of each inout ('exc') in the activity 'act': key, name, amount, unit, CPC code, etc
 #for exc in act.technosphere():
 #    print(exc.as_dict())
 
-#For each product of interest, list it MF (material footprint) and MC (material composition) after technosphere filtering 
-for prod in prod_list:
-    act = activity_by_name(prod, db)
-    lca = LCA_create(act, FU)
-    lca.lci() #creates technosphere
-
-    print("\n>>> BEFORE filtering:\n")
-    print(f'\u25A0 Material footprint, MF (based on inventory vector) in {FU} {act}:')
-    materials_inv(BIO_MAT_LIST, lca, prod)
-    print("\u25A0 Material footprint, MF (based on supply array):")
-    materials_sup(materials_dict_cutoff310, lca, prod) 
-
-    lca_exclude_noninc(db, lca) #edit matrix (technosphere)
-    lca.lci_calculation()
-
-    print("\n>>> AFTER filtering:\n")
-    print(f'\u25A0 Material composition, MC (based on inventory vector) in {FU} {act}:')
-    materials_inv(BIO_MAT_LIST, lca, prod)
-    print("\u25A0 Material composition, MC (based on supply array):")
-    materials_sup(materials_dict_cutoff310, lca, prod)
+#All products of interest at once: tidy table of MF and MC for each product and material
+if BATCH:
+    acts = pmc.activities_by_name(prod_list, db)
+    lca = LCA_load(db)
+    table = pmc.batch_composition(lca, acts, lca_inc(db, lca), materials_dict_cutoff310, BIO_MAT_LIST, FU, [prod_wght[prod_list.index(prod)] for prod in prod_list])
+    table.to_csv(BATCH_OUT, index=False)
+    print(table.to_string())
+    print(inc_variants_compare(lca, acts, avoid_variants, pmc.compile_materials(materials_dict_cutoff310, lca)).to_string())
+    if MC_ITERATIONS:
+        certain = pmc.inc_vector(lca, [word for word in avoid_activities if word not in avoid_uncertain]) #the uncertain keywords are drawn in every iteration, so they must not be filtered out already
+        bands = pmc.monte_carlo(lca, acts, certain, materials_dict_cutoff310, BIO_MAT_LIST, MC_ITERATIONS, avoid_uncertain, amount=FU, workers=MC_WORKERS)
+        bands.to_csv(MC_OUT, index=False)
+        print(bands.to_string())
+
+#Quick screening: MC of each product from the part of its supply chain above TRAVERSE_CUTOFF, with a bound of the missing mass
+elif TRAVERSE_CUTOFF:
+    lca = LCA_load(db)
+    inc = lca_inc(db, lca)
+    materials = pmc.compile_materials(materials_dict_cutoff310, lca)
+    masses = pmc.row_masses(lca) #kg per unit of each activity, to turn the unexpanded demand into a bound of the missing mass
+    for act in pmc.activities_by_name(prod_list, db):
+        table = pmc.traverse_composition(lca, act, inc, materials, amount=FU, cutoff=TRAVERSE_CUTOFF, masses=masses)
+        print(f'\n\u25A0 Material composition, MC (supply-chain traversal, {table.attrs["expanded"]} activities) in {FU} {act}: error bound {round(table["bound"][0], FLOAT_RND)} kg (inf: demand of non-mass units left unexpanded)')
+        print(table[table['MC'] != 0].drop(columns=['unexpanded', 'bound']).round(FLOAT_RND).to_string(index=False))
+
+else:
+    #For each product of interest, list it MF (material footprint) and MC (material composition) after technosphere filtering 
+    materials = None
+    for prod in prod_list:
+        act = activity_by_name(prod, db)
+        lca = LCA_create(act, FU)
+        pmc.lci(lca) #creates technosphere; its LU factorization is cached on disk, so it is only computed once per database version
+        if materials is None: #the activities of the database are in the same matrix columns for all products, so the material dictionary and the incorporation scenarios are compiled only once
+            materials = pmc.compile_materials(materials_dict_cutoff310, lca)
+            inc = lca_inc(db, lca)
+            overlays = inc_overlays(lca, {'MC': inc})
+
+        print("\n>>> BEFORE filtering:\n")
+        print(f'\u25A0 Material footprint, MF (based on inventory vector) in {FU} {act}:')
+        materials_inv(BIO_MAT_LIST, lca, prod)
+        print("\u25A0 Material footprint, MF (based on supply array):")
+        materials_sup(materials, lca, prod) 
+
+        lca_overlay(lca, overlays['MC']) #swaps the values of the technosphere matrix to the filtered amounts; its factorization is computed once and then taken from the cache
+        lca.lci_calculation()
+
+        print("\n>>> AFTER filtering:\n")
+        print(f'\u25A0 Material composition, MC (based on inventory vector) in {FU} {act}:')
+        materials_inv(BIO_MAT_LIST, lca, prod)
+        print("\u25A0 Material composition, MC (based on supply array):")
+        materials_sup(materials, lca, prod)
+        if PATHS_TOP:
+            print("\u25A0 Top supply-chain paths of the MC:")
+            print(pmc.contribution_paths(lca, act, inc, materials, top=PATHS_TOP, amount=FU).round(FLOAT_RND).to_string(index=False))
         
 print('DONE')
\ No newline at end of file
@@ -35,12 +35,13 @@ Created on Wed Jul 17 2019
 #IMPORTS:
 import brightway2 as bw #import Brightway package 
 import numpy as np #import Numpy package 
+import pmc_functions as pmc #import array-based helper functions shared with the ecoinvent script
+import re
 
 #CONSTANTS:
 PROD = 'laptop' #the name of the reference product (unit process) of interest whose MC we aim to estimate; there should be an activity named PROD in your 'db' database, otherwise an error will pop-up
 BIO_MAT_LIST  = ["Copper", "Oil, crude"] #the natural material of interest (the appropariate flow in the biospere database will be selected later on based on this name). The name should start with the capital letter (see conventional names of materials/metals in the biosphere3 database)
 DB_NAME   = 'db' #the LCI database that will be imported and used (can be ecoinvent in real applications). In our case, it is called 'db' and was first created in Activity Browser, defining a simplified laptop supply chain described in the paper referenced below (incl. copper extraction, factory, motherboard production, etc)
-KEY_index = 1 #index of the actual activity/bioflow key in a conventional tuple key like (db, key)  
 
 #PREPARATIONS:
     
@@ -48,7 +49,6 @@ KEY_index = 1 #index of the actual activity/bioflow key in a conventional tuple
 #bw.projects.new_project("My LCA project") #Create a new Brightway project named "My LCA project", 
 bw.projects.set_current("default") #Opens the existing default project
 db  = bw.Database(DB_NAME) #Imports the selected LCI database (can be ecoinvent in real applications). In our case, it is called 'db' and was first created in Activity Browser, defining a simplified laptop supply chain described in the paper (incl. copper extraction, factory, motherboard production, etc)
-bio = bw.Database('biosphere3')
 
 #THE VOID LIST:
 #   Here we define the list of keywords (inputs) that will be filtered our from the supply chain as being non-incorporated in the following products (see the Paper)
@@ -71,53 +71,46 @@ materials_dict = {
 #   Here, we defined functions used in the algorithm
 
 #This function allows to select acivity object from the 'db' LCI database based on a presence of the word 'name' in its name  
+#(the shortest matching name wins; the lookup uses a name index that is built once per database version, see pmc.name_index)
 def activity_by_name(name, db):
-    candidates = [x for x in db if name in x['name']]
-    return candidates[0]
-
-#Obtain activity object given its 'key': tuple(db, key) -> activity/dataset
-def activity_by_key(key): 
-    return db.get(key[KEY_index])
+    return pmc.activity_by_name(name, db)
 
 #List all intermediate (technosphere) flows (activities) in the resulting supply-array (see the Paper) that is stored in the reuslting 'lca' object
-def list_techno_inventory(lca):
+# (only the non-zero ones above 'threshold', largest first; the names come from a cached index instead of one database lookup per activity)
+def list_techno_inventory(lca, threshold=0.0):
     print("\u25A0 Supply array: ")
-    for k in lca.activity_dict:
-        print(activity_by_key(k)["name"], ": ", lca.supply_array[lca.activity_dict[k]])
+    for name, amount in pmc.supply_table(lca, threshold)[['name', 'amount']].itertuples(index=False):
+        print(name, ": ", amount)
     print()
     
-#Given predefined 'materials_dict' (see above), aggregates and prints 
+#Given predefined 'materials_dict' (see above) compiled with pmc.compile_materials() into 'materials', aggregates and prints 
 # resulting material fllows (MC or MF of a product, depending if filtering was applied) 
 # using the 'supply_array' from the resulting 'lca' object
-def composition_sup(materials_dict, lca):
-    for material_group in materials_dict:
-        gr_sum = 0
-        for material in materials_dict[material_group]:
-            mat_sum = 0
-            for act_key in materials_dict[material_group][material]:
-                mat_sum += lca.supply_array[lca.activity_dict[act_key]]
-            print(material, " : ", mat_sum, ' kg')
-            gr_sum += mat_sum
-        print('>',material_group, "in total : ", gr_sum, ' kg')
+def composition_sup(materials, lca):
+    amounts, totals = pmc.material_amounts(materials, lca.supply_array) #the material dictionary is a sparse aggregation matrix, so all materials and groups are summed at once
+    for group_index, material_group in enumerate(materials['groups']):
+        for material_index in np.sort(materials['rollup'][group_index].indices):
+            print(materials['materials'][material_index][1], " : ", amounts[material_index], ' kg')
+        print('>',material_group, "in total : ", totals[group_index], ' kg')
     print('\n')
 
 #Given predefined natural materials in the 'mat_list' (see BIO_MAT_LIST above), prints 
 # resulting material fllows (MC or MF of a product, depending if filtering was applied) 
 # using the 'inventory vector' (see Paper) from the resulting 'lca' object
 def composition_inv(mat_list, lca): 
-    for flow_index, amount in enumerate(lca.inventory.sum(axis=1).flat): # lca.inventory.sum(axis=1).flat gives you the summed inventory for each biosphere flow
-        flow_key = list(lca.biosphere_dict.items())[flow_index][0][KEY_index] #obtain key of each bioflow (in the resulting 'inventory') based on the 'biosphere_dict' that lists the keys of the resulting elementary flows 
-        flow_name = bio.get(flow_key)['name'] #obtain name of each bioflow using its key based on the 'bio' database that contains the names of all elementary flows
-        if flow_name in mat_list:
-            print(flow_name, ": ", amount)  
-
-#Prints technospheere matrix (A)
-def print_techno_matrix(lca):
-    matrix_size = np.shape(lca.technosphere_matrix)[0]
-    for i in range(matrix_size):
-        print("\n")
-        for j in range(matrix_size):
-            print(lca.technosphere_matrix[i, j], end = ' ')         
+    flows = pmc.biosphere_flows(lca) #table with the key, name and category of each bioflow (row of the 'inventory'), read from the database only once and kept in memory
+    rows = pmc.material_rows(lca, mat_list) #row indices of the bioflows named in 'mat_list', resolved once and reused in every report
+    amounts = np.asarray(lca.inventory.sum(axis=1)).ravel()[rows] # lca.inventory.sum(axis=1) gives you the summed inventory for each biosphere flow
+    for flow_name, amount in zip(flows['name'].to_numpy()[rows], amounts):
+        print(flow_name, ": ", amount)  
+
+#Prints a dense block of the technospheere matrix (A) of at most 'size' x 'size' entries around the activity 'act' (the activity and its largest inputs)
+def print_techno_matrix(lca, act, size=10):
+    print(pmc.technosphere_block(lca, act, size).to_string())
+
+#Writes the non-zeros of the technospheere matrix (A) above 'threshold' with the activity names to 'path' (.csv, or .parquet with pyarrow)
+def export_techno_matrix(lca, path, threshold=0.0):
+    print(pmc.export_technosphere(lca, path, threshold), 'entries of the technosphere matrix written to', path)
 
 #MAIN CODE:
 #   Here, our algorithm starts executing using the variables and functions provided above
@@ -125,44 +118,43 @@ def print_techno_matrix(lca):
 #selecting the activity that represents (produces) the product ('PROD') of interest within given LCI database 'db'
 act = activity_by_name(PROD, db)
 
-#assigning material incorporation parameter ('dissip'), see the Paper, to each (intermediate) flow ('exc') in the database 
-#in this case we scan only inputs of the reference activity 'act', whereas in full algorithm whole database should be scanned; 
-#here, filtering out is done in an automatic manner, based on the list of keywords to avoid ('list_dissip') 
-#here 0 or 1 but can be anything in between
-for exc in act.technosphere():
-    exc_name = activity_by_key(exc["input"])["name"]
-    exc['dissip'] = 1 if exc_name in list_dissip else 0
-    exc.save()
-    
 #selecting the functional unit (quantity of the reference product of interest, e.g. one laptop)
 functional_unit = {act: 1}
 #pick method from the list of impact methods; in practice arbitrary as it does not impact the resulting inventory/supply vectors but is needed to run the lca.lci() command
 method_key = ('ReCiPe 2016 v1.03, endpoint (H)', 'natural resources', 'material resources: metals/minerals')
 #prepare an 'lca' object based on the funtional unit and the impact method (see Brightway 2 framework)
 lca = bw.LCA(functional_unit, method_key) 
-#running LCIA prior to filtering out the non-incorporated flows 
-lca.lci()
+#running LCIA prior to filtering out the non-incorporated flows (the LU factorization of the technosphere matrix is cached on disk)
+pmc.lci(lca)
+#linking the material dictionary to the columns of the technosphere matrix (keys that do not link to any activity are reported here)
+materials = pmc.compile_materials(materials_dict, lca)
+
+#assigning material incorporation parameter, see the Paper, to each (intermediate) flow of the technosphere matrix at once (the 'inc' vector);
+#in this case the rule covers only the inputs of the reference activity 'act' (tier 1) named in the list of keywords to avoid ('list_dissip'),
+#whereas in the full algorithm the whole database is scanned (tiers=None); rules can also match product classes and tiers,
+#here 0 or 1 but can be anything in between (see pmc.incorporation)
+inc = pmc.incorporation(lca, [('^(?:' + '|'.join(map(re.escape, list_dissip)) + ')$', 0, [1])], product=act, names=pmc.row_products(lca, 'name'))
 
 #list 1) the resulting supply-array prior to filtering, 
 # 2) the MF of the product and material of interest,
 # 3) the aggregated MF of the product for all materials listed in the dictionary above;
 # see the Paper for terminology: inventory vector, supply-array, MC, MF, material aggregation dictionary, etc
 print("\n>>> BEFORE filtering:\n")
+#print_techno_matrix(lca, act) #the product and its largest inputs; export_techno_matrix(lca, 'technosphere.csv') writes the whole matrix
 list_techno_inventory(lca)
 print("\u25A0 Material footprint, MF (based on inventory vector):")
 composition_inv(BIO_MAT_LIST, lca)
 print("\n\u25A0 Material footprint, MF (based on supply array):")
-composition_sup(materials_dict, lca)
+composition_sup(materials, lca)
 
-#removing the non-incorporated inputs from the reference product activity in the technosphere matrix 
-# based on the non-incorporation parameter ('dissip') applied above (see Paper for the description of this param.)
-for exc in act.technosphere():
-    if  exc['dissip']:
-        row = lca.activity_dict[exc["input"]]
-        col = lca.activity_dict[act.key]
-        lca.technosphere_matrix[row, col] = 0
+#removing the non-incorporated inputs from the technosphere matrix in one go
+# based on the material incorporation parameters ('inc') assigned above (see Paper for the description of this param.)
+base = lca.technosphere_matrix
+lca.technosphere_matrix = pmc.filtered_technosphere(lca, inc)
 
 #re-calculating LCI again after filtering out the non-incorporated flows
+#only the column of the reference product changed: solved as a low-rank update of the factorization of 'base' (no refactorization)
+pmc.use_factorization(lca, base)
 lca.lci_calculation()
 
 #lists 1) the resulting supply-array after filtering, 
@@ -174,4 +166,4 @@ list_techno_inventory(lca)
 print("\u25A0 Material composition, MC (based on inventory vector):")
 composition_inv(BIO_MAT_LIST, lca)
 print("\n\u25A0 Material composition, MC (based on supply array):")
-composition_sup(materials_dict, lca)
\ No newline at end of file
+composition_sup(materials, lca)
\ No newline at end of file
@@ -0,0 +1,883 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2024 Netherlands eScience Center and CML, Leiden University
+# Licensed under the Apache License, version 2.0. See LICENSE for details.
+
+#NOTES:
+#   Array-based helper functions shared by "pmc algorithm - ecoinvent.py" and "pmc algorithm - general.py".
+#   Instead of walking the LCI database activity by activity (and saving every exchange back to SQLite),
+#   these functions work on the packed technosphere data of a Brightway 2 'lca' object:
+#   'lca.tech_params' holds one record per exchange with its matrix 'row', 'col', 'type' and 'amount',
+#   so per-exchange quantities (e.g. the material incorporation parameter) can be kept as plain numpy
+#   arrays aligned with it - the so-called sidecar arrays.
+
+#IMPORTS:
+from concurrent.futures import ProcessPoolExecutor
+from bw2data.backends.peewee import ActivityDataset, ExchangeDataset, sqlite3_lci_db
+from bw2data import databases, projects
+from collections import OrderedDict
+from datetime import datetime
+from functools import lru_cache, partial
+from pathlib import Path
+from scipy import linalg, sparse
+from scipy.sparse import csgraph
+from scipy.sparse.linalg import splu, spsolve_triangular
+import hashlib
+import heapq
+import json
+import numpy as np
+import os
+import pandas as pd
+import pickle
+import re
+import shutil
+import tempfile
+
+#CONSTANTS:
+TECHNOSPHERE = 1 #'type' code of technosphere (input) exchanges in 'lca.tech_params' (see TYPE_DICTIONARY in bw2data)
+NAME_MODES = ('substring', 'prefix', 'exact') #supported matching modes of activity_by_name()
+CATALOG_FIELDS = ('name', 'key', 'reference product', 'location', 'unit', 'classification') #columns of the activity catalog (see db_to_catalog)
+FACTOR_ARRAYS = ('L_data', 'L_indices', 'L_indptr', 'U_data', 'U_indices', 'U_indptr', 'perm_r', 'perm_c', 'shape') #files of a cached LU factorization
+MAX_UPDATE_RANK = 50 #at most this many changed matrix columns are solved with a low-rank update of an existing factorization, more are refactorized
+FACTORIZATIONS_KEPT = 8 #number of LU factorizations kept in the cache on disk and in memory (the least recently used ones are deleted)
+UNIT_MASSES = {'kilogram': 1.0, 'gram': 1e-3, 'ton': 1e3, 'metric ton': 1e3} #kg per unit of the mass units of reference products (see row_masses)
+INC_DTYPE = [('input', np.uint32), ('output', np.uint32), ('type', np.uint8), ('incorporated', np.float64)] #layout of the sidecar array with incorporation parameters
+
+_NAME_INDEXES = {} #name indexes already loaded in this session: {database name: index}
+_FACTORIZATIONS = OrderedDict() #LU factorizations already loaded in this session: {matrix key: factors}, the FACTORIZATIONS_KEPT most recently used
+
+#FUNCTIONS:
+
+#Returns a cheap version stamp of the database 'db' that changes whenever the database is modified (used as a cache key):
+# the content digest kept by the data lineage hooks (hackathon/data-lineage/dl_digest.py), if it was saved after the last
+# modification of the database, otherwise its modification time and size
+def db_version(db):
+    digest = lineage_digest(db)
+    if digest is not None:
+        return 'digest|' + digest
+    return f"{databases[db.name].get('modified')}|{len(db)}"
+
+#Returns the content digest of the database 'db' from <project dir>/lineage/digests.json, or None if there is none
+# or it may be out of date (the file is older than the last modification of the database)
+def lineage_digest(db):
+    path = os.path.join(str(projects.dir), 'lineage', 'digests.json')
+    modified = databases[db.name].get('modified')
+    if not os.path.exists(path) or modified is None or os.path.getmtime(path) < datetime.fromisoformat(modified).timestamp():
+        return None
+    with open(path, 'r') as fp:
+        return json.load(fp).get(db.name)
+
+#Returns the name index of the database 'db': activity names and codes sorted by name length (shortest first, then alphabetically)
+# plus an inverted index from each 3-character substring (trigram) to the positions of the names containing it.
+# The index is built once per database version and stored in the project directory, so later sessions only load it.
+def name_index(db):
+    version = db_version(db)
+    index = _NAME_INDEXES.get(db.name)
+    if index is not None and index['version'] == version:
+        return index
+    path = projects.request_directory('pmc') / (db.name + '_names.pickle')
+    if path.exists():
+        with open(path, 'rb') as fp:
+            index = pickle.load(fp)
+    if index is None or index['version'] != version:
+        index = _build_name_index(db, version)
+        with open(path, 'wb') as fp:
+            pickle.dump(index, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    _NAME_INDEXES[db.name] = index
+    return index
+
+def _build_name_index(db, version):
+    query = ActivityDataset.select(ActivityDataset.name, ActivityDataset.code).where(ActivityDataset.database == db.name).tuples()
+    activities = sorted(((name or '', code) for name, code in query), key=lambda item: (len(item[0]), item[0], item[1]))
+    names = [name for name, _ in activities]
+    trigrams, exact = {}, {}
+    for position, name in enumerate(names):
+        exact.setdefault(name, position)
+        for gram in {name[i:i + 3] for i in range(len(name) - 2)}:
+            trigrams.setdefault(gram, []).append(position)
+    return {'version': version,
+            'names': names,
+            'codes': [code for _, code in activities],
+            'trigrams': {gram: np.array(positions, dtype=np.int32) for gram, positions in trigrams.items()},
+            'exact': exact}
+
+#Returns the positions (in the name index) of the names that can contain 'name' in ascending order:
+# the names sharing its rarest trigrams (the candidates are verified by the caller anyway)
+def _name_candidates(index, name, rarest=3):
+    grams = {name[i:i + 3] for i in range(len(name) - 2)}
+    if not grams: #too short for the trigram index
+        return range(len(index['names']))
+    postings = sorted((index['trigrams'].get(gram, np.empty(0, dtype=np.int32)) for gram in grams), key=len)
+    candidates = postings[0]
+    for posting in postings[1:rarest]:
+        if not len(candidates):
+            break
+        candidates = np.intersect1d(candidates, posting, assume_unique=True)
+    return candidates
+
+#Returns the position of the best match for 'name' in the name index (the shortest matching name) or None;
+# 'mode' is one of NAME_MODES: the activity name contains 'name', starts with it, or equals it
+def _name_position(index, name, mode):
+    if mode == 'exact':
+        return index['exact'].get(name)
+    if mode not in NAME_MODES:
+        raise ValueError(f"Unknown name matching mode '{mode}', use one of {NAME_MODES}")
+    names = index['names']
+    for position in _name_candidates(index, name):
+        if (name in names[position]) if mode == 'substring' else names[position].startswith(name):
+            return int(position)
+    return None
+
+#Returns the activity of the database 'db' whose name matches 'name' (see NAME_MODES); the shortest name is the best match
+def activity_by_name(name, db, mode='substring'):
+    index = name_index(db)
+    position = _name_position(index, name, mode)
+    if position is None:
+        raise IndexError(f"No activity matching '{name}' ({mode}) in the {db.name} database")
+    return db.get(index['codes'][position])
+
+#Resolves a whole list of 'names' to activities of the database 'db' with the same name index (see activity_by_name)
+def activities_by_name(names, db, mode='substring'):
+    return [activity_by_name(name, db, mode) for name in names]
+
+#Exports the activity catalog of the database 'db' into 'path' (.npy): a NumPy structured array with one fixed-width text column
+# per CATALOG_FIELDS ('key' is the activity code), read with one SQL query. It can be opened memory-mapped (zero-copy) with open_catalog().
+# The version stamp of the database is kept in '<path>.version': the export is skipped while the database is unchanged
+def db_to_catalog(db, path=None):
+    path = path or db.name + '.npy'
+    version = db_version(db)
+    if _catalog_version(path) == version:
+        return path
+    query = (ActivityDataset
+             .select(ActivityDataset.name, ActivityDataset.code, ActivityDataset.product, ActivityDataset.location, ActivityDataset.data)
+             .where(ActivityDataset.database == db.name)
+             .tuples())
+    rows = [(name or '', code, product or '', location or '', data.get('unit') or '',
+             '; '.join(f'{system}: {value}' for system, value in data.get('classifications', [])))
+            for name, code, product, location, data in query]
+    widths = [max([len(row[i]) for row in rows], default=0) or 1 for i in range(len(CATALOG_FIELDS))]
+    np.save(path, np.array(rows, dtype=[(field, f'U{width}') for field, width in zip(CATALOG_FIELDS, widths)]))
+    with open(path + '.version', 'w') as fp:
+        fp.write(version)
+    return path
+
+#Opens the activity catalog 'path' (see db_to_catalog) memory-mapped; with 'db' given it is exported again first if the database changed
+def open_catalog(path, db=None):
+    if db is not None:
+        db_to_catalog(db, path)
+    return np.load(path, mmap_mode='r')
+
+def _catalog_version(path):
+    if not (os.path.exists(path) and os.path.exists(path + '.version')):
+        return None
+    with open(path + '.version', 'r') as fp:
+        return fp.read()
+
+#Returns the reference product names ('field' = 'name': the activity names) of all rows of the technosphere matrix of 'lca',
+# read with one SQL query (instead of one bw.get_activity() call per exchange)
+def row_products(lca, field='product'):
+    db_names = list({key[0] for key in lca.product_dict})
+    query = (ActivityDataset
+             .select(ActivityDataset.database, ActivityDataset.code, ActivityDataset.product if field == 'product' else ActivityDataset.name)
+             .where(ActivityDataset.database << db_names)
+             .tuples())
+    products = {(database, code): product or '' for database, code, product in query}
+    _, rev_product, _ = lca.reverse_dict()
+    return np.array([products.get(rev_product[row], '') for row in range(len(rev_product))], dtype=object)
+
+#Returns the mass (kg) per unit of the reference product of every row of the technosphere matrix of 'lca' from its unit and the
+# conversion factors 'units' (one SQL query); rows with other units (e.g. kWh, m3, unit) get infinity, i.e. no known mass
+def row_masses(lca, units=UNIT_MASSES):
+    db_names = list({key[0] for key in lca.product_dict})
+    query = (ActivityDataset
+             .select(ActivityDataset.database, ActivityDataset.code, ActivityDataset.data)
+             .where(ActivityDataset.database << db_names)
+             .tuples())
+    masses = {(database, code): units.get(data.get('unit'), np.inf) for database, code, data in query}
+    _, rev_product, _ = lca.reverse_dict()
+    return np.array([masses.get(rev_product[row], np.inf) for row in range(len(rev_product))])
+
+#Builds the material incorporation vector (one factor per exchange, aligned with 'lca.tech_params'):
+# technosphere inputs whose product name contains any of the 'avoid_activities' keywords get 0, all other exchanges get 1.
+# The keyword list is compiled into a single regular expression and matched against all product names at once.
+def inc_vector(lca, avoid_activities, names=None):
+    params = lca.tech_params
+    inc = np.ones(len(params))
+    if not avoid_activities:
+        return inc
+    if names is None:
+        names = row_products(lca)
+    pattern = "|".join(re.escape(word) for word in avoid_activities)
+    row_avoid = pd.Series(names, dtype=str).str.contains(pattern, regex=True).to_numpy()
+    inc[(params['type'] == TECHNOSPHERE) & row_avoid[params['row']]] = 0.0
+    return inc
+
+#Builds a fractional incorporation vector (aligned with 'lca.tech_params') for the whole supply chain from 'rules' (pattern, factor, tiers):
+# each rule multiplies the factor of the technosphere inputs whose input name ('names', default: row_products) matches the regular
+# expression 'pattern' (None: all inputs) by 'factor', optionally only in the given 'tiers' of the supply chain of the activity 'product'
+# (see exchange_tiers). 'exchanges' ({(input key, output key): factor}) sets the factors of single exchanges last.
+# E.g. inc_vector(lca, keywords) is incorporation(lca, [('|'.join(map(re.escape, keywords)), 0, None)]).
+def incorporation(lca, rules=(), exchanges=None, product=None, names=None):
+    params = lca.tech_params
+    technosphere = params['type'] == TECHNOSPHERE
+    inc = np.ones(len(params))
+    if rules and names is None:
+        names = row_products(lca)
+    tiers = None
+    for pattern, factor, rule_tiers in rules:
+        selected = technosphere.copy()
+        if pattern is not None:
+            selected &= pd.Series(names, dtype=str).str.contains(pattern, regex=True).to_numpy()[params['row']]
+        if rule_tiers is not None:
+            if tiers is None:
+                tiers = exchange_tiers(lca, product)
+            selected &= np.isin(tiers, list(rule_tiers))
+        inc[selected] *= factor
+    if exchanges:
+        n_cols = len(lca.activity_dict)
+        ids = np.array([lca.product_dict[tuple(input_key)] * n_cols + lca.activity_dict[tuple(output_key)] for input_key, output_key in exchanges],
+                       dtype=np.int64)
+        factors = _lookup(ids, list(exchanges.values()), params['row'].astype(np.int64) * n_cols + params['col'], default=np.nan)
+        overridden = technosphere & ~np.isnan(factors)
+        inc[overridden] = factors[overridden]
+    return inc
+
+#Returns the tier of each exchange of 'lca' in the supply chain of the activity 'product': 1 for the inputs of 'product', 2 for the inputs
+# of its suppliers, etc. (shortest path); exchanges outside the supply chain and non-technosphere exchanges get 0
+def exchange_tiers(lca, product):
+    params = lca.tech_params
+    _, rev_product, _ = lca.reverse_dict()
+    supplier = np.array([lca.activity_dict.get(rev_product[row], -1) for row in range(len(rev_product))])[params['row']]
+    edges = (params['type'] == TECHNOSPHERE) & (supplier >= 0)
+    graph = sparse.csr_matrix((np.ones(edges.sum()), (params['col'][edges], supplier[edges])), shape=(len(lca.activity_dict),) * 2)
+    depth = csgraph.shortest_path(graph, indices=lca.activity_dict[product.key], unweighted=True)[params['col']]
+    return np.where((params['type'] == TECHNOSPHERE) & np.isfinite(depth), depth + 1, 0).astype(np.int64)
+
+#Builds one incorporation vector per keyword list in 'variants' (e.g. alternative 'avoid_activities' lists) as the columns of a matrix;
+# the input names are read once and every distinct keyword is matched only once
+def inc_variants(lca, variants, names=None):
+    params = lca.tech_params
+    if names is None:
+        names = row_products(lca)
+    series = pd.Series(names, dtype=str)
+    matches = {word: series.str.contains(word, regex=False).to_numpy() for word in {word for variant in variants for word in variant}}
+    incs = np.ones((len(params), len(variants)))
+    for k, variant in enumerate(variants):
+        row_avoid = np.zeros(len(names), dtype=bool)
+        for word in variant:
+            row_avoid |= matches[word]
+        incs[(params['type'] == TECHNOSPHERE) & row_avoid[params['row']], k] = 0.0
+    return incs
+
+#Solves the supply arrays of all columns of 'demand' for every incorporation vector (columns of 'incs'): returns an array
+# (rows x demands x variants). The first variant is factorized once; the others are solved as low-rank updates of it
+# when they differ in a few matrix columns, and factorized (with the cache) otherwise, see updated_solver
+def variant_supplies(lca, incs, demand):
+    base = filtered_technosphere(lca, incs[:, 0])
+    return np.stack([updated_solver(base, filtered_technosphere(lca, incs[:, k]) if k else base)(demand)
+                     for k in range(incs.shape[1])], axis=-1)
+
+#Saves the incorporation vector 'inc' into the sidecar file 'path' (.npy) together with the (input, output, type) of each exchange,
+# so that it can be re-aligned with 'tech_params' of any later 'lca' object built from the same database
+def inc_save(lca, inc, path):
+    params = lca.tech_params
+    sidecar = np.zeros(len(params), dtype=INC_DTYPE)
+    for field in ('input', 'output', 'type'):
+        sidecar[field] = params[field]
+    sidecar['incorporated'] = inc
+    np.save(path, sidecar)
+    return path
+
+#Loads the incorporation vector from the sidecar file 'path' aligned with 'lca.tech_params';
+# exchanges not present in the sidecar (e.g. added to the database later) get the full incorporation of 1
+def inc_load(lca, path):
+    sidecar = np.load(path)
+    params = lca.tech_params
+    if len(sidecar) == len(params) and all(np.array_equal(sidecar[field], params[field]) for field in ('input', 'output', 'type')):
+        return sidecar['incorporated'].copy() #same processed database, same exchange order
+    return _lookup(_exchange_ids(sidecar), sidecar['incorporated'], _exchange_ids(params))
+
+#Packs (input, output, type) of each exchange into one sortable integer id
+def _exchange_ids(array):
+    return (array['input'].astype(np.uint64) << np.uint64(34)) | (array['output'].astype(np.uint64) << np.uint64(2)) | (array['type'].astype(np.uint64) & np.uint64(3))
+
+#Looks up the 'wanted' integer ids among the 'stored' ones and returns their 'values' ('default' for ids that are not stored)
+def _lookup(stored, values, wanted, default=1.0):
+    result = np.full(len(wanted), default, dtype=np.float64)
+    if not len(stored):
+        return result
+    order = np.argsort(stored, kind='stable')
+    pos = np.searchsorted(stored[order], wanted).clip(max=len(order) - 1)
+    found = stored[order][pos] == wanted
+    result[found] = np.asarray(values, dtype=np.float64)[order][pos[found]]
+    return result
+
+#Builds the incorporation vector (aligned with 'lca.tech_params') from the 'incorporated' parameters stored in the exchanges of 'db',
+# read with one SQL query; exchanges without the parameter (not set in AB or by db_inc_filter() previously) get 1
+def inc_from_db(db, lca):
+    query = (ExchangeDataset
+             .select(ExchangeDataset.input_database, ExchangeDataset.input_code,
+                     ExchangeDataset.output_database, ExchangeDataset.output_code, ExchangeDataset.data)
+             .where((ExchangeDataset.output_database == db.name) & (ExchangeDataset.type == 'technosphere'))
+             .tuples())
+    n_cols = len(lca.activity_dict)
+    ids, values, missing = [], [], 0
+    for input_database, input_code, output_database, output_code, data in query:
+        row = lca.product_dict.get((input_database, input_code))
+        col = lca.activity_dict.get((output_database, output_code))
+        if row is None or col is None:
+            continue
+        if 'incorporated' not in data:
+            missing += 1
+            continue
+        ids.append(row * n_cols + col)
+        values.append(data['incorporated'])
+    if missing:
+        print(f'Error: missing incorporation parameter for {missing} exchanges in the LCI database detected! -> assigned to 1')
+    params = lca.tech_params
+    inc = _lookup(np.array(ids, dtype=np.int64), values, params['row'].astype(np.int64) * n_cols + params['col'])
+    inc[params['type'] != TECHNOSPHERE] = 1.0
+    return inc
+
+#Returns a new technosphere matrix of 'lca' built in one go from the packed (row, col) data and the exchange 'amounts'
+# (aligned with 'lca.tech_params', e.g. an overlay); the original 'lca.technosphere_matrix' is left untouched
+def technosphere_matrix(lca, amounts):
+    params = lca.tech_params
+    amounts = np.array(amounts, dtype=np.float64)
+    amounts[params['type'] == TECHNOSPHERE] *= -1 #inputs enter the technosphere matrix with a negative sign
+    return sparse.csr_matrix((amounts, (params['row'], params['col'])), shape=lca.technosphere_matrix.shape)
+
+#Returns a new technosphere matrix of 'lca' with every exchange scaled by its incorporation factor in 'inc' (aligned with 'lca.tech_params')
+def filtered_technosphere(lca, inc):
+    return technosphere_matrix(lca, amount_overlay(lca, inc))
+
+#Returns an overlay of the exchange amounts of 'lca' scaled by the incorporation vector 'inc' (aligned with 'lca.tech_params').
+# Overlays are plain arrays next to the base amounts in 'lca.tech_params': the stored database is never edited.
+def amount_overlay(lca, inc):
+    return lca.tech_params['amount'] * np.asarray(inc, dtype=np.float64)
+
+#Switches the technosphere matrix of 'lca' to the amounts of 'overlay' (None switches back to the base amounts of the database).
+# All overlays share one sparsity pattern, so a switch only replaces the values of the matrix (the first switch builds the pattern);
+# the solver is then taken from the factorization cache (see use_factorization). The matrix object is updated in place,
+# so keep a copy of lca.technosphere_matrix if the previous amounts are still needed.
+def apply_overlay(lca, overlay=None):
+    layout = _overlay_layout(lca)
+    amounts = np.asarray(lca.tech_params['amount'] if overlay is None else overlay, dtype=np.float64)
+    data = np.bincount(layout['mapping'], weights=amounts * layout['sign'], minlength=len(layout['indices'])) #duplicates are summed
+    if lca.technosphere_matrix is layout.get('matrix'):
+        lca.technosphere_matrix.data = data
+    else:
+        lca.technosphere_matrix = layout['matrix'] = sparse.csr_matrix((data, layout['indices'], layout['indptr']), shape=lca.technosphere_matrix.shape)
+    return use_factorization(lca)
+
+#Sparsity pattern (CSR 'indices' and 'indptr') of the technosphere matrix of 'lca' and the 'mapping' from the exchanges in 'lca.tech_params'
+# to the entries of the matrix, worked out once per 'lca.tech_params' and kept on the 'lca' object
+def _overlay_layout(lca):
+    layout = getattr(lca, 'overlay_layout', None)
+    if layout is None or layout['params'] is not lca.tech_params:
+        params = lca.tech_params
+        n_rows, n_cols = lca.technosphere_matrix.shape
+        entries, mapping = np.unique(params['row'].astype(np.int64) * n_cols + params['col'], return_inverse=True) #row-major, as in CSR
+        layout = lca.overlay_layout = {'params': params, 'mapping': mapping.ravel(),
+                                       'sign': np.where(params['type'] == TECHNOSPHERE, -1.0, 1.0), #inputs are negative in the technosphere matrix
+                                       'indices': entries % n_cols, 'indptr': np.searchsorted(entries // n_cols, np.arange(n_rows + 1))}
+    return layout
+
+#Saves several named overlays side by side into the file 'path' (.npz) together with the (input, output, type) of each exchange
+def overlays_save(lca, overlays, path):
+    np.savez(path, exchange_ids=_exchange_ids(lca.tech_params), **{'overlay_' + name: overlay for name, overlay in overlays.items()})
+    return path
+
+#Loads the named overlays saved by overlays_save() aligned with 'lca.tech_params'; exchanges missing in the file keep their base amounts
+def overlays_load(lca, path):
+    overlays = {}
+    with np.load(path) as data:
+        stored, wanted = data['exchange_ids'], _exchange_ids(lca.tech_params)
+        for field in data.files:
+            if field.startswith('overlay_'):
+                overlay = _lookup(stored, data[field], wanted, default=np.nan)
+                missing = np.isnan(overlay)
+                overlay[missing] = lca.tech_params['amount'][missing]
+                overlays[field[len('overlay_'):]] = overlay
+    return overlays
+
+#Returns the biosphere index of 'lca': a table with the key, name and categories of each row of its biosphere matrix.
+# The index is read from SQLite (one query) only once per project and biosphere matrix layout and then kept in memory.
+def biosphere_flows(lca):
+    return _biosphere_table(projects.current, _biosphere_keys(lca))
+
+#Resolves the natural materials in 'mat_list' to the rows of the biosphere matrix of 'lca' (once per list, then cached),
+# so reporting them is a single fancy-index operation, e.g. lca.inventory.sum(axis=1)[material_rows(lca, mat_list)]
+def material_rows(lca, mat_list):
+    return _material_rows(projects.current, _biosphere_keys(lca), tuple(mat_list))
+
+#Keys of the biosphere flows of 'lca' in the order of the biosphere matrix rows
+def _biosphere_keys(lca):
+    return tuple(key for key, _ in sorted(lca.biosphere_dict.items(), key=lambda item: item[1]))
+
+@lru_cache(maxsize=8)
+def _biosphere_table(project, keys):
+    db_names = list({key[0] for key in keys})
+    query = (ActivityDataset
+             .select(ActivityDataset.database, ActivityDataset.code, ActivityDataset.name, ActivityDataset.data)
+             .where(ActivityDataset.database << db_names)
+             .tuples())
+    flows = {(database, code): (name, '::'.join(data.get('categories', ()))) for database, code, name, data in query}
+    return pd.DataFrame([(key,) + flows.get(key, ('', '')) for key in keys], columns=['key', 'name', 'categories'])
+
+@lru_cache(maxsize=64)
+def _material_rows(project, keys, mat_list):
+    rows = np.flatnonzero(_biosphere_table(project, keys)['name'].isin(mat_list).to_numpy())
+    rows.flags.writeable = False #shared by all callers
+    return rows
+
+#Returns the activity names of the rows and of the columns of the technosphere matrix of 'lca' (two arrays), read from SQLite
+# with one query only once per project and matrix layout and then kept in memory (like biosphere_flows)
+def technosphere_names(lca):
+    rev_activity, rev_product, _ = lca.reverse_dict()
+    return _technosphere_names(projects.current, tuple(rev_product[i] for i in range(len(rev_product))),
+                               tuple(rev_activity[i] for i in range(len(rev_activity))))
+
+@lru_cache(maxsize=8)
+def _technosphere_names(project, row_keys, col_keys):
+    db_names = list({key[0] for key in row_keys + col_keys})
+    query = (ActivityDataset
+             .select(ActivityDataset.database, ActivityDataset.code, ActivityDataset.name)
+             .where(ActivityDataset.database << db_names)
+             .tuples())
+    names = {(database, code): name for database, code, name in query}
+    arrays = tuple(np.array([names.get(key, '') for key in keys], dtype=object) for keys in (row_keys, col_keys))
+    for array in arrays:
+        array.flags.writeable = False #shared by all callers
+    return arrays
+
+#Writes the non-zeros of the sparse 'matrix' (e.g. lca.technosphere_matrix) whose absolute value is above 'threshold' as COO triples
+# (row, col, amount; plus 'row name'/'col name' when 'row_names'/'col_names' are given, see technosphere_names) to 'path'
+# (.csv, or .parquet with pyarrow). The matrix is exported in blocks of rows with about 'chunksize' non-zeros, so neither a dense
+# matrix nor a full copy in COO format is ever built. Returns the number of triples written.
+def export_sparse(matrix, path, row_names=None, col_names=None, threshold=0.0, chunksize=1_000_000):
+    matrix = sparse.csr_matrix(matrix)
+    parquet = str(path).endswith('.parquet')
+    if parquet:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        fields = [('row', pa.int64()), ('col', pa.int64()), ('amount', pa.float64())]
+        fields += [(name, pa.string()) for name, names in (('row name', row_names), ('col name', col_names)) if names is not None]
+        schema = pa.schema(fields) #explicit, since an empty first chunk would give the name columns the type null
+    writer, written = None, 0
+    try:
+        for table in _coo_chunks(matrix, row_names, col_names, threshold, chunksize):
+            if parquet:
+                writer = writer or pq.ParquetWriter(path, schema)
+                writer.write_table(pa.Table.from_pandas(table, schema=schema, preserve_index=False))
+            else:
+                table.to_csv(path, mode='a' if written else 'w', header=not written, index=False)
+            written += len(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    return written
+
+#Yields the entries of the CSR 'matrix' above 'threshold' as tables of COO triples, one block of rows (about 'chunksize' non-zeros) at a time;
+# the first table is yielded even when it is empty, so the export always has a header
+def _coo_chunks(matrix, row_names, col_names, threshold, chunksize):
+    start, first = 0, True
+    while first or start < matrix.shape[0]:
+        stop = min(matrix.shape[0], max(start + 1, int(np.searchsorted(matrix.indptr, matrix.indptr[start] + chunksize, side='right')) - 1))
+        block = matrix[start:stop].tocoo()
+        keep = np.abs(block.data) > threshold
+        table = pd.DataFrame({'row': block.row[keep] + start, 'col': block.col[keep], 'amount': block.data[keep]})
+        if row_names is not None:
+            table['row name'] = np.asarray(row_names)[table['row'].to_numpy()]
+        if col_names is not None:
+            table['col name'] = np.asarray(col_names)[table['col'].to_numpy()]
+        if first or len(table):
+            yield table
+        start, first = stop, False
+
+#Writes the technosphere matrix of 'lca' to 'path' as COO triples with the activity names (see export_sparse)
+def export_technosphere(lca, path, threshold=0.0, chunksize=1_000_000):
+    row_names, col_names = technosphere_names(lca)
+    return export_sparse(lca.technosphere_matrix, path, row_names, col_names, threshold, chunksize)
+
+#Returns the non-zero entries of the supply array of 'lca' (absolute value above 'threshold') as a table (col, name, amount),
+# sorted by absolute amount, without a database lookup per activity
+def supply_table(lca, threshold=0.0):
+    supply = np.asarray(lca.supply_array).ravel()
+    cols = np.flatnonzero(np.abs(supply) > threshold)
+    cols = cols[np.argsort(-np.abs(supply[cols]), kind='stable')]
+    return pd.DataFrame({'col': cols, 'name': technosphere_names(lca)[1][cols], 'amount': supply[cols]})
+
+#Returns a dense block of at most 'size' x 'size' entries of the technosphere matrix of 'lca' (or of 'matrix') around the activity 'act':
+# the activity, its inputs, their inputs and so on (largest inputs first), labelled with the activity names
+def technosphere_block(lca, act, size=10, matrix=None):
+    matrix = sparse.csc_matrix(lca.technosphere_matrix if matrix is None else matrix)
+    order = [lca.activity_dict[act.key]]
+    for j in order:
+        if len(order) >= size:
+            break
+        column = matrix[:, j]
+        for i in column.indices[np.argsort(-np.abs(column.data), kind='stable')]:
+            if i not in order and len(order) < size:
+                order.append(i)
+    row_names, col_names = technosphere_names(lca)
+    return pd.DataFrame(matrix[order][:, order].toarray(), index=row_names[order], columns=col_names[order])
+
+#Builds the demand (right-hand-side) matrix with one column per activity in 'acts', each demanding 'amount' of its reference product
+def demand_matrix(lca, acts, amount=1):
+    demand = np.zeros((len(lca.product_dict), len(acts)))
+    for j, act in enumerate(acts):
+        demand[lca.product_dict[act.key], j] = amount
+    return demand
+
+#Solves the technosphere 'matrix' for all columns of 'demand' at once with a single (cached) LU factorization; returns the supply arrays as columns
+def supply_arrays(matrix, demand):
+    return lu_solve(factorization(matrix), demand)
+
+#Returns the key of the technosphere 'matrix' in the factorization cache: a digest of its structure (shape and sparsity pattern)
+# followed by a digest of its values
+def matrix_key(matrix):
+    matrix = sparse.csc_matrix(matrix, copy=True)
+    matrix.sum_duplicates() #canonical form: sorted indices, no duplicates
+    structure = hashlib.sha256(np.array(matrix.shape, dtype=np.int64).tobytes() + matrix.indptr.astype(np.int64).tobytes()
+                               + matrix.indices.astype(np.int64).tobytes()).hexdigest()[:16]
+    return structure + '-' + hashlib.sha256(matrix.data.astype(np.float64).tobytes()).hexdigest()[:16]
+
+#Returns the LU factors of the technosphere 'matrix' (perm_r, perm_c, L, U of scipy's splu) for lu_solve().
+# The factors are stored as .npy files in the project directory under the key of the matrix (see matrix_key) and opened
+# memory-mapped, so a later session with an unchanged database (or overlay) skips the factorization completely.
+def factorization(matrix):
+    key = matrix_key(matrix)
+    if key in _FACTORIZATIONS:
+        _FACTORIZATIONS.move_to_end(key)
+        return _FACTORIZATIONS[key]
+    cache = projects.request_directory('pmc') / 'factorizations'
+    directory = cache / key
+    if not directory.exists():
+        lu = splu(sparse.csc_matrix(matrix))
+        arrays = {'perm_r': lu.perm_r, 'perm_c': lu.perm_c, 'shape': np.array(matrix.shape)}
+        for name, factor in (('L', lu.L.tocsr()), ('U', lu.U.tocsr())):
+            factor.sort_indices()
+            arrays.update({name + '_data': factor.data, name + '_indices': factor.indices, name + '_indptr': factor.indptr})
+        cache.mkdir(parents=True, exist_ok=True)
+        temporary = Path(tempfile.mkdtemp(prefix=key + '.', suffix='.tmp', dir=cache)) #unique, several processes may factorize the same matrix
+        for name in FACTOR_ARRAYS:
+            np.save(temporary / (name + '.npy'), arrays[name])
+        try:
+            temporary.rename(directory) #complete factorizations only
+        except OSError: #another process stored the same factorization first
+            shutil.rmtree(temporary, ignore_errors=True)
+            if not directory.exists():
+                raise
+        for old in sorted((path for path in cache.iterdir() if path.suffix != '.tmp'), key=lambda path: path.stat().st_mtime)[:-FACTORIZATIONS_KEPT]:
+            shutil.rmtree(old, ignore_errors=True)
+    os.utime(directory)
+    arrays = {name: np.load(directory / (name + '.npy'), mmap_mode='r') for name in FACTOR_ARRAYS}
+    shape = tuple(arrays['shape'])
+    factors = {'L': sparse.csr_matrix((arrays['L_data'], arrays['L_indices'], arrays['L_indptr']), shape=shape),
+               'U': sparse.csr_matrix((arrays['U_data'], arrays['U_indices'], arrays['U_indptr']), shape=shape),
+               'perm_r': arrays['perm_r'], 'perm_c': arrays['perm_c']}
+    _FACTORIZATIONS[key] = factors
+    if len(_FACTORIZATIONS) > FACTORIZATIONS_KEPT:
+        _FACTORIZATIONS.popitem(last=False)
+    return factors
+
+#Solves A x = b with the LU 'factors' of A (see factorization) for one right-hand side or for the columns of a matrix 'b':
+# Pr A Pc = L U, so x is found by two triangular solves and the two permutations
+def lu_solve(factors, b):
+    b = np.asarray(b, dtype=np.float64)
+    y = np.empty_like(b)
+    y[factors['perm_r']] = b
+    y = spsolve_triangular(factors['L'], y, lower=True, unit_diagonal=True)
+    return spsolve_triangular(factors['U'], y, lower=False)[factors['perm_c']]
+
+#Returns a solver (function of the right-hand side) for the technosphere 'matrix' that reuses the factorization of 'base', an earlier
+# technosphere matrix of the same size (e.g. before filtering). If 'matrix' differs from 'base' in k <= 'max_rank' columns, the change is
+# a rank-k update A + C E' (C: the k column differences, E: the k unit vectors) solved with the Sherman-Morrison-Woodbury formula:
+# x = y - Z (I + E' Z)^-1 E' y with y = A^-1 b and Z = A^-1 C, i.e. k extra solves with the existing factors and a small k x k system.
+# With more changed columns (or a near-singular k x k system) 'matrix' is factorized itself instead.
+def updated_solver(base, matrix, max_rank=MAX_UPDATE_RANK):
+    difference = sparse.csc_matrix(matrix) - sparse.csc_matrix(base)
+    difference.eliminate_zeros()
+    cols = np.flatnonzero(np.diff(difference.indptr))
+    if len(cols) > max_rank:
+        return partial(lu_solve, factorization(matrix))
+    factors = factorization(base)
+    if len(cols) == 0:
+        return partial(lu_solve, factors)
+    z = lu_solve(factors, difference[:, cols].toarray())
+    capacitance = np.eye(len(cols)) + z[cols, :]
+    if np.linalg.cond(capacitance) > 1e12:
+        return partial(lu_solve, factorization(matrix))
+    return partial(_woodbury_solve, factors, cols, z, linalg.lu_factor(capacitance))
+
+def _woodbury_solve(factors, cols, z, capacitance, b):
+    y = lu_solve(factors, b)
+    return y - z @ linalg.lu_solve(capacitance, y[cols])
+
+#Lets 'lca' solve its current technosphere matrix with the cached factorization: lca.lci_calculation() then only does the
+# triangular solves. Call it again whenever lca.technosphere_matrix is replaced or edited; with the previous matrix as 'base',
+# a change in a few columns is solved as a low-rank update of its factorization (see updated_solver)
+def use_factorization(lca, base=None):
+    if base is None:
+        lca.solver = partial(lu_solve, factorization(lca.technosphere_matrix))
+    else:
+        lca.solver = updated_solver(base, lca.technosphere_matrix)
+    return lca
+
+#Same as lca.lci(), but with the technosphere matrix solved with the cached factorization (see use_factorization)
+def lci(lca):
+    lca.load_lci_data()
+    lca.build_demand_array()
+    use_factorization(lca)
+    lca.lci_calculation()
+    return lca
+
+#Compiles the material dictionary 'materials_dict' (group -> material -> list of activity keys) for the activities of 'lca' into
+# a sparse aggregation matrix (materials x activities) and a roll-up matrix (groups x materials), so the MC of any supply array
+# (or of a batch of supply arrays as columns) is a sparse matrix product, see material_amounts().
+# Keys that do not link to an activity of 'lca' are reported here and left out, instead of failing in the middle of a run.
+def compile_materials(materials_dict, lca):
+    groups, materials, rows, cols, missing = list(materials_dict), [], [], [], []
+    for material_group in materials_dict:
+        for material in materials_dict[material_group]:
+            for act_key in materials_dict[material_group][material]:
+                col = lca.activity_dict.get(tuple(act_key)) #keys from JSON files are given as lists [db_name, key]
+                if col is None:
+                    missing.append(tuple(act_key))
+                    continue
+                rows.append(len(materials))
+                cols.append(col)
+            materials.append((material_group, material))
+    if missing:
+        print(f'Error: {len(missing)} keys in the material dictionary do not link to any activity in the LCI database and are left out: {missing}')
+    group_rows = [groups.index(material_group) for material_group, _ in materials]
+    return {'groups': groups,
+            'materials': materials,
+            'aggregation': sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(materials), len(lca.activity_dict))),
+            'rollup': sparse.csr_matrix((np.ones(len(materials)), (group_rows, np.arange(len(materials)))), shape=(len(groups), len(materials))),
+            'missing': missing}
+
+#Returns the amounts of all compiled 'materials' (see compile_materials) and of their groups
+# for one supply array or for a batch of supply arrays given as the columns of a matrix
+def material_amounts(materials, supply):
+    amounts = materials['aggregation'] @ supply
+    return amounts, materials['rollup'] @ amounts
+
+#Estimates the MF (unfiltered technosphere) and the MC (technosphere filtered with the incorporation vector 'inc') of all products in 'acts' at once.
+# Each of the two technosphere matrices is factorized only once and all products are solved as one right-hand-side matrix.
+# Returns a tidy table with one row per product and material: natural materials of 'mat_list' from the inventory vector
+# (one row per biosphere flow, 'group' is the flow category) and the materials of 'materials_dict' from the supply array.
+# With 'weights' (kg per product, aligned with 'acts') the shares of the product weight are added as well.
+def batch_composition(lca, acts, inc, materials_dict, mat_list, amount=1, weights=None):
+    demand = demand_matrix(lca, acts, amount)
+    supply = {'MF': supply_arrays(filtered_technosphere(lca, np.ones(len(lca.tech_params))), demand),
+              'MC': supply_arrays(filtered_technosphere(lca, inc), demand)}
+    materials = compile_materials(materials_dict, lca)
+    rows = material_rows(lca, mat_list)
+    labels = composition_labels(lca, materials, rows)
+    table = pd.DataFrame(labels * len(acts), columns=['basis', 'group', 'material'])
+    table.insert(0, 'product', np.repeat([act['name'] for act in acts], len(labels)))
+    for result in ('MF', 'MC'):
+        inventory = lca.biosphere_matrix @ supply[result]
+        values = np.vstack([inventory[rows], material_amounts(materials, supply[result])[0]])
+        table[result] = values.T.ravel()
+        if weights is not None:
+            table[result + ' %'] = table[result] / np.repeat(weights, len(labels)) * 100
+    return table
+
+#Labels (basis, group, material) of the results of batch_composition/monte_carlo: the natural materials in the biosphere 'rows'
+# of the inventory vector, then the compiled 'materials' of the supply array
+def composition_labels(lca, materials, rows):
+    flows = biosphere_flows(lca)
+    return ([('inventory vector', flows['categories'][index], flows['name'][index]) for index in rows]
+            + [('supply array', material_group, material) for material_group, material in materials['materials']])
+
+#Monte Carlo version of batch_composition: percentile bands of the MF and MC of all products in 'acts'.
+# In every iteration the technosphere and biosphere amounts are drawn from their uncertainty distributions (stats_arrays, as in
+# bw2calc's MonteCarloLCA) and, with 'keywords' ({avoid keyword: probability that it really marks non-incorporated inputs}),
+# the incorporation factors are drawn as well: each keyword is switched on with its probability and 'inc' is multiplied by the
+# resulting keyword filter; 'inc' must therefore not filter out the inputs matching 'keywords' already (a keyword can only switch
+# factors off, so it would have no effect). Draws are vectorized over blocks of 'block' iterations; the blocks run in 'workers' processes.
+# Every iteration reuses the fill-reducing column ordering of the first factorization and only refactorizes the numeric values.
+# Returns a tidy table (product, basis, group, material, result ['MF'/'MC'], mean and one column per percentile).
+def monte_carlo(lca, acts, inc, materials_dict, mat_list, iterations=1000, keywords=None, names=None, amount=1,
+                percentiles=(2.5, 50, 97.5), block=10, workers=None, seed=None):
+    materials = compile_materials(materials_dict, lca)
+    rows = material_rows(lca, mat_list)
+    words = list(keywords or {})
+    if words and names is None:
+        names = row_products(lca)
+    model = {'tech_params': lca.tech_params, 'bio_params': lca.bio_params, 'shape': lca.technosphere_matrix.shape,
+             'bio_shape': lca.biosphere_matrix.shape, 'demand': demand_matrix(lca, acts, amount), 'inc': np.asarray(inc, dtype=np.float64),
+             'aggregation': materials['aggregation'], 'rows': rows,
+             'order': _column_order(technosphere_matrix(lca, lca.tech_params['amount'])),
+             'probabilities': np.array([keywords[word] for word in words]),
+             'matches': sparse.csr_matrix(np.column_stack([pd.Series(names, dtype=str).str.contains(word, regex=False).to_numpy()
+                                                           for word in words])) if words else None}
+    sizes = [min(block, iterations - start) for start in range(0, iterations, block)]
+    seeds = [int(state) for state in np.random.SeedSequence(seed).generate_state(len(sizes))]
+    if workers == 1:
+        _mc_init(model)
+        results = [_mc_block(block_seed, size) for block_seed, size in zip(seeds, sizes)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_mc_init, initargs=(model,)) as executor:
+            results = list(executor.map(_mc_block, seeds, sizes))
+    samples = np.concatenate(results, axis=0) #iterations x result (MF, MC) x labels x products
+    labels = composition_labels(lca, materials, rows)
+    table = pd.DataFrame([(act['name'],) + label + (result,) for act in acts for result in ('MF', 'MC') for label in labels],
+                         columns=['product', 'basis', 'group', 'material', 'result'])
+    values = samples.transpose(0, 3, 1, 2).reshape(len(samples), -1) #iterations x (product, result, label)
+    table['mean'] = values.mean(axis=0)
+    for percentile, column in zip(percentiles, np.percentile(values, percentiles, axis=0)):
+        table[f'p{percentile:g}'] = column
+    return table
+
+#Fill-reducing column ordering of the technosphere 'matrix' (from scipy's splu); factorizing matrix[:, order] with the 'NATURAL'
+# ordering gives the same fill-in and skips the ordering step for every matrix with the same sparsity pattern
+def _column_order(matrix):
+    perm_c = splu(sparse.csc_matrix(matrix)).perm_c
+    order = np.empty_like(perm_c)
+    order[perm_c] = np.arange(len(perm_c))
+    return order
+
+_MC_MODEL = {} #data of the Monte Carlo run, set once per worker process (see monte_carlo)
+
+def _mc_init(model):
+    _MC_MODEL.update(model)
+
+#Runs 'size' Monte Carlo iterations in the current process; returns the results as an array (iterations x (MF, MC) x labels x products)
+def _mc_block(seed, size):
+    from stats_arrays import MCRandomNumberGenerator
+    model = _MC_MODEL
+    params, bio_params, order = model['tech_params'], model['bio_params'], model['order']
+    technosphere = params['type'] == TECHNOSPHERE
+    tech_amounts = MCRandomNumberGenerator(params, seed=seed).generate(size)
+    bio_amounts = MCRandomNumberGenerator(bio_params, seed=seed + 1).generate(size)
+    incs = np.repeat(model['inc'][:, None], size, axis=1)
+    if model['matches'] is not None:
+        active = np.random.default_rng(seed).random((len(model['probabilities']), size)) < model['probabilities'][:, None]
+        row_avoid = (model['matches'] @ active) > 0
+        incs[technosphere[:, None] & row_avoid[params['row']]] = 0.0
+    tech_amounts[technosphere] *= -1
+    results = []
+    for k in range(size):
+        biosphere = sparse.csr_matrix((bio_amounts[:, k], (bio_params['row'], bio_params['col'])), shape=model['bio_shape'])
+        iteration = []
+        for inc in (None, incs[:, k]):
+            values = tech_amounts[:, k] if inc is None else tech_amounts[:, k] * inc
+            matrix = sparse.csc_matrix((values, (params['row'], params['col'])), shape=model['shape'])
+            supply = np.empty_like(model['demand'])
+            supply[order] = splu(matrix[:, order], permc_spec='NATURAL').solve(model['demand'])
+            iteration.append(np.vstack([(biosphere @ supply)[model['rows']], model['aggregation'] @ supply]))
+        results.append(iteration)
+    return np.array(results)
+
+#Quick screening of the MC of the activity 'act' without solving the whole technosphere: a supply-chain traversal (like bw2calc's
+# graph traversal) over the technosphere filtered with 'inc' that only visits the part of the supply chain the product depends on.
+# Starting from the demand of 'amount', the activity with the largest unexpanded demand is taken from a priority queue, its output
+# is added to the supply and its incorporated inputs (non-incorporated inputs have a zero amount in the filtered matrix and are
+# skipped) are passed on as new demands. Branches whose demand is below 'cutoff' (relative to 'amount') are not expanded, and the
+# traversal stops after 'max_calc' expansions. 'lca' only needs its technosphere data loaded (lca.load_lci_data()), not lca.lci().
+# Returns a table with the MC of the 'selected' materials (names in the compiled 'materials', default: all), the demand left unexpanded
+# ('unexpanded', summed in the units of the unexpanded activities, so only a rough measure) and, with 'masses' (kg per unit of each
+# row of the technosphere, see row_masses), an error bound in kg: the unexpanded demands converted to mass. It bounds the missing
+# material mass when the incorporated inputs of every activity weigh at most as much as its output (the mass balance behind the MC),
+# and is infinite when demand of an activity without a known mass per unit is left. Since all amounts of the filtered technosphere
+# are usually positive, the MC found is a lower bound and MC + bound an upper bound.
+def traverse_composition(lca, act, inc, materials, selected=None, amount=1, cutoff=1e-4, max_calc=100000, masses=None):
+    matrix = sparse.csc_matrix(filtered_technosphere(lca, inc))
+    production = matrix.diagonal()
+    columns = [index for index, (_, material) in enumerate(materials['materials']) if selected is None or material in selected]
+    aggregation = sparse.csc_matrix(materials['aggregation'][columns])
+    start = lca.product_dict[act.key]
+    supply, residual = {}, {start: float(amount)}
+    queue = [(-abs(amount), start)]
+    expanded = 0
+    while queue and expanded < max_calc:
+        priority, j = heapq.heappop(queue)
+        demand = residual.get(j, 0.0)
+        if demand == 0.0 or -priority != abs(demand): #stale queue entry: the demand of j changed after it was queued
+            continue
+        if abs(demand) < cutoff * abs(amount):
+            break
+        del residual[j]
+        scale = demand / production[j]
+        supply[j] = supply.get(j, 0.0) + scale
+        expanded += 1
+        for pointer in range(matrix.indptr[j], matrix.indptr[j + 1]):
+            i = matrix.indices[pointer]
+            if i == j or matrix.data[pointer] == 0:
+                continue
+            residual[i] = residual.get(i, 0.0) - matrix.data[pointer] * scale #inputs are negative in the technosphere matrix
+            heapq.heappush(queue, (-abs(residual[i]), i))
+    rows, values = np.fromiter(supply, dtype=np.int64, count=len(supply)), np.fromiter(supply.values(), dtype=np.float64, count=len(supply))
+    found = aggregation[:, rows] @ values
+    left = {i: abs(demand) for i, demand in residual.items() if demand != 0}
+    table = pd.DataFrame([materials['materials'][index] for index in columns], columns=['group', 'material'])
+    table['MC'] = found
+    table['unexpanded'] = sum(left.values())
+    if masses is not None:
+        table['bound'] = sum(demand * masses[i] for i, demand in left.items())
+    table.attrs.update(expanded=expanded, unexpanded=len(residual))
+    return table
+
+#Top supply-chain paths that carry the MC of the activity 'act' (technosphere filtered with 'inc') to the markets of each of the
+# 'selected' materials (names in the compiled 'materials', default: all). The material content per unit of every activity
+# (one transposed solve of the filtered technosphere, factorized once and cached) is the exact value of all paths that continue
+# from an activity, so a best-first search over partial paths, ordered by path demand x content, finds the 'top' paths of each
+# material in decreasing order. Paths end where they first reach a market of the material; their amount includes what loops
+# back through the market (so all paths of a material add up to its MC). At most 'max_calc' partial paths are expanded per
+# material and paths are at most 'max_length' activities long. Activities are named with 'names' (default: row_products(lca, 'name'),
+# one query). Returns a table (product, material, rank, amount, share of the material's MC, length, path).
+def contribution_paths(lca, act, inc, materials, selected=None, top=5, amount=1, max_calc=10000, max_length=20, names=None):
+    if names is None:
+        names = row_products(lca, 'name')
+    matrix = sparse.csc_matrix(filtered_technosphere(lca, inc))
+    production = matrix.diagonal()
+    columns = [index for index, (_, material) in enumerate(materials['materials']) if selected is None or material in selected]
+    aggregation = sparse.csr_matrix(materials['aggregation'][columns])
+    contents = supply_arrays(sparse.csc_matrix(matrix.T), aggregation.T.toarray()) #activities x materials, per unit of demand
+    start = lca.product_dict[act.key]
+    rows = []
+    for k, index in enumerate(columns):
+        markets = set(aggregation[k].indices)
+        content = contents[:, k]
+        total = amount * content[start]
+        queue = [(-abs(total), (start,), float(amount))]
+        found, expanded = 0, 0
+        while queue and found < top and expanded < max_calc:
+            _, path, demand = heapq.heappop(queue)
+            j = path[-1]
+            if j in markets:
+                found += 1
+                value = demand * content[j]
+                rows.append((act['name'], materials['materials'][index][1], found, value, value / total if total else np.nan,
+                             len(path), ' > '.join(names[i] for i in path)))
+                continue
+            expanded += 1
+            if len(path) == max_length:
+                continue
+            scale = demand / production[j]
+            for pointer in range(matrix.indptr[j], matrix.indptr[j + 1]):
+                i = matrix.indices[pointer]
+                if i == j or matrix.data[pointer] == 0 or content[i] == 0:
+                    continue
+                input_demand = -matrix.data[pointer] * scale #inputs are negative in the technosphere matrix
+                heapq.heappush(queue, (-abs(input_demand * content[i]), path + (i,), input_demand))
+    return pd.DataFrame(rows, columns=['product', 'material', 'rank', 'amount', 'share', 'length', 'path'])
+
+#Writes the incorporation vector 'inc' into the 'incorporated' parameter of the technosphere exchanges of 'db'.
+# Only needed when the parameter should be stored in the database itself (e.g. to see it in Activity Browser);
+# all exchanges are updated in a single transaction.
+def db_inc_write(db, lca, inc):
+    rev_activity, rev_product, _ = lca.reverse_dict()
+    params = lca.tech_params
+    factors = {}
+    for i in np.flatnonzero(params['type'] == TECHNOSPHERE):
+        factors[(rev_product[params['row'][i]], rev_activity[params['col'][i]])] = float(inc[i])
+    exchanges = ExchangeDataset.select().where((ExchangeDataset.output_database == db.name) & (ExchangeDataset.type == 'technosphere'))
+    with sqlite3_lci_db.transaction():
+        for exc in exchanges:
+            exc.data['incorporated'] = factors.get(((exc.input_database, exc.input_code), (exc.output_database, exc.output_code)), 1.0)
+            exc.save()
@@ -0,0 +1,219 @@
+# Helper functions for the Bonsai import notebook (io_bonsai_import.ipynb):
+# streaming the tidy tables (bonsai_data/*.gzip) into COO arrays chunk by chunk, and
+# solver backends for the technosphere matrix of hybrid IO databases, which are much denser than ecoinvent.
+#
+#   direct    sparse LU (pypardiso if installed, otherwise scipy's splu); best for small or very sparse matrices
+#   gmres     GMRES preconditioned with an incomplete LU factorization (ILU)
+#   bicgstab  BiCGSTAB preconditioned with ILU
+#   neumann   Leontief power series: A = D (I - M) with D the diagonal (production), so x = sum_k M^k D^-1 b;
+#             converges when the spectral radius of M is below 1 (and fast when it is small, as in most IO tables)
+import time
+from pathlib import Path
+
+import bw2data as bd
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.linalg import LinearOperator, bicgstab, gmres, spilu, splu
+
+try:
+    import pypardiso
+except ImportError:
+    pypardiso = None
+
+BACKENDS = ('direct', 'gmres', 'bicgstab', 'neumann')
+DIRECT_SIZE = 5000  # matrices up to this size are always factorized
+DIRECT_DENSITY = 1e-3  # sparser matrices (like ecoinvent) factorize with little fill-in
+CHUNKSIZE = 1_000_000  # entries of the tidy value tables parsed at a time
+VALUE_DTYPES = {'row': np.int64, 'col': np.int64, 'amount': np.float64}
+NEUMANN_RADIUS = 0.5  # power series only when this bound on the spectral radius holds (error shrinks at least 2x per term)
+
+
+# codes of the matrix indices in the index tables: products (rows) and activities (columns) as 'code|region',
+# like the codes of the imported activities, and extensions (rows of the extensions table) by name
+def index_codes(dirpath):
+    dirpath = Path(dirpath)
+    hiot = pd.read_csv(dirpath / 'index_table_hiot.gzip', compression='gzip', dtype=str)
+    extensions = pd.read_csv(dirpath / 'index_table_extensions.gzip', compression='gzip', dtype=str)
+    return {'product': (hiot['row_code'] + '|' + hiot['row_region']).to_numpy(),
+            'activity': (hiot['col_code'] + '|' + hiot['col_region']).to_numpy(),
+            'extension': extensions['row_code'].to_numpy()}
+
+
+# lookup array from table index to target index (e.g. matrix indices of the imported database), given the 'codes' of the
+# table indices (see index_codes) and a 'mapping' {code: target index}; used to map the value tables on the fly
+def index_lookup(codes, mapping):
+    return np.array([mapping[code] for code in codes], dtype=np.int64)
+
+
+# yields the tidy value 'table' ('product_value_table' or 'extensions_value_table') as (rows, cols, amounts) arrays of 'chunksize' entries,
+# decompressed and parsed one chunk at a time; with 'row_lookup'/'col_lookup' (see index_lookup) the indices are mapped on the fly
+def value_chunks(dirpath, table, chunksize=CHUNKSIZE, row_lookup=None, col_lookup=None):
+    reader = pd.read_csv(Path(dirpath) / (table + '.gzip'), compression='gzip', chunksize=chunksize,
+                         usecols=['row', 'col', 'amount'], dtype=VALUE_DTYPES)
+    with reader:
+        for chunk in reader:
+            rows, cols = chunk['row'].to_numpy(), chunk['col'].to_numpy()
+            yield (rows if row_lookup is None else row_lookup[rows],
+                   cols if col_lookup is None else col_lookup[cols],
+                   chunk['amount'].to_numpy())
+
+
+# COO arrays (rows, cols, amounts) of the value 'table' read chunk by chunk (see value_chunks). Without 'directory' the chunks are
+# concatenated in memory; with 'directory' each chunk is appended to raw files there and the arrays are returned memory-mapped,
+# so the memory use stays at one chunk however large the table is
+def coo_arrays(dirpath, table, chunksize=CHUNKSIZE, row_lookup=None, col_lookup=None, directory=None):
+    chunks = value_chunks(dirpath, table, chunksize, row_lookup, col_lookup)
+    names, dtypes = ('row', 'col', 'amount'), (np.int64, np.int64, np.float64)
+    if directory is None:
+        parts = [[], [], []]
+        for arrays in chunks:
+            for part, array, dtype in zip(parts, arrays, dtypes):
+                part.append(array.astype(dtype, copy=False))
+        return tuple(np.concatenate(part) if part else np.zeros(0, dtype) for part, dtype in zip(parts, dtypes))
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    paths = [directory / f'{table}.{name}.bin' for name in names]
+    files = [open(path, 'wb') for path in paths]
+    try:
+        for arrays in chunks:
+            for fp, array, dtype in zip(files, arrays, dtypes):
+                array.astype(dtype, copy=False).tofile(fp)
+    finally:
+        for fp in files:
+            fp.close()
+    return tuple(np.memmap(path, dtype=dtype, mode='r') if path.stat().st_size else np.zeros(0, dtype) for path, dtype in zip(paths, dtypes))
+
+
+# matrix indices of the imported 'database' in 'lca' (bw2calc 2) by node code, for the rows (products) and columns (activities):
+# the mappings for index_lookup, so the tidy tables can be streamed straight into the matrix layout of the imported database
+def technosphere_mappings(lca, database):
+    nodes = {node['code']: node.id for node in bd.Database(database)}
+    return ({code: lca.dicts.product[id] for code, id in nodes.items() if id in lca.dicts.product},
+            {code: lca.dicts.activity[id] for code, id in nodes.items() if id in lca.dicts.activity})
+
+
+# technosphere matrix from the tidy product table (row, col, amount), streamed chunk by chunk; its size is given by the index table.
+# With 'products'/'activities' ({code: matrix index}, see technosphere_mappings) the table indices are mapped on the fly to those
+# matrix indices (e.g. of the imported database in an LCA) and 'shape' defaults to the largest mapped index
+def load_technosphere(dirpath, chunksize=CHUNKSIZE, directory=None, products=None, activities=None, shape=None):
+    codes = index_codes(dirpath)
+    row_lookup = None if products is None else index_lookup(codes['product'], products)
+    col_lookup = None if activities is None else index_lookup(codes['activity'], activities)
+    rows, cols, amounts = coo_arrays(dirpath, 'product_value_table', chunksize, row_lookup, col_lookup, directory)
+    if shape is None:
+        shape = (len(codes['product']) if row_lookup is None else int(row_lookup.max(initial=-1)) + 1,
+                 len(codes['activity']) if col_lookup is None else int(col_lookup.max(initial=-1)) + 1)
+    return sparse.csc_matrix((amounts, (rows, cols)), shape=shape)
+
+
+# biosphere (extensions) matrix from the tidy extensions table, streamed chunk by chunk; 'extensions'/'activities' map the
+# table indices on the fly as in load_technosphere
+def load_extensions(dirpath, chunksize=CHUNKSIZE, directory=None, extensions=None, activities=None, shape=None):
+    codes = index_codes(dirpath)
+    row_lookup = None if extensions is None else index_lookup(codes['extension'], extensions)
+    col_lookup = None if activities is None else index_lookup(codes['activity'], activities)
+    rows, cols, amounts = coo_arrays(dirpath, 'extensions_value_table', chunksize, row_lookup, col_lookup, directory)
+    if shape is None:
+        shape = (len(codes['extension']) if row_lookup is None else int(row_lookup.max(initial=-1)) + 1,
+                 len(codes['activity']) if col_lookup is None else int(col_lookup.max(initial=-1)) + 1)
+    return sparse.csc_matrix((amounts, (rows, cols)), shape=shape)
+
+
+# the matrix M of the power series (A = D (I - M)) and D^-1
+def leontief_split(matrix):
+    inverse_diagonal = 1 / matrix.diagonal()
+    m = sparse.identity(matrix.shape[0], format='csr') - sparse.diags(inverse_diagonal) @ sparse.csr_matrix(matrix)
+    m.eliminate_zeros()
+    return m, inverse_diagonal
+
+
+# cheap upper bound of the spectral radius of M: the smaller of its largest absolute row and column sums
+def spectral_radius_bound(matrix):
+    m = abs(leontief_split(matrix)[0])
+    return min(np.asarray(m.sum(axis=0)).max(initial=0), np.asarray(m.sum(axis=1)).max(initial=0))
+
+
+# backend for 'matrix' from its size, density and (for dense matrices) the spectral radius bound of the power series
+def choose_backend(matrix):
+    size = matrix.shape[0]
+    density = matrix.nnz / size ** 2
+    if size <= DIRECT_SIZE or density <= DIRECT_DENSITY:
+        return 'direct'
+    if np.all(matrix.diagonal() != 0) and spectral_radius_bound(matrix) < NEUMANN_RADIUS:
+        return 'neumann'
+    return 'gmres'
+
+
+# returns a function solving 'matrix' x = b for a demand vector b, with all setup work (factorization, preconditioner) done once here;
+# usable as lca.solver in bw2calc (see lci below)
+def solver(matrix, backend='auto', rtol=1e-10, max_terms=1000):
+    if backend == 'auto':
+        backend = choose_backend(matrix)
+    matrix = sparse.csc_matrix(matrix)
+    if backend == 'direct':
+        if pypardiso is not None:
+            return lambda b: pypardiso.spsolve(matrix, b)
+        return splu(matrix).solve
+    if backend in ('gmres', 'bicgstab'):
+        ilu = spilu(matrix, drop_tol=1e-5, fill_factor=10)
+        preconditioner = LinearOperator(matrix.shape, ilu.solve)
+        method = gmres if backend == 'gmres' else bicgstab
+
+        def solve(b):
+            x, info = method(matrix, b, x0=ilu.solve(b), rtol=rtol, M=preconditioner)
+            if info != 0:
+                raise RuntimeError(f'{backend} did not converge (info={info}), use backend="direct"')
+            return x
+        return solve
+    if backend == 'neumann':
+        m, inverse_diagonal = leontief_split(matrix)
+
+        def solve(b):
+            term = inverse_diagonal * b
+            x = term.copy()
+            for _ in range(max_terms):
+                term = m @ term
+                x += term
+                if np.linalg.norm(term) <= rtol * np.linalg.norm(x):
+                    return x
+            raise RuntimeError(f'power series did not converge in {max_terms} terms, use backend="gmres"')
+        return solve
+    raise ValueError(f'Unknown backend {backend!r}, use "auto" or one of {BACKENDS}')
+
+
+# same as lca.lci(), but the technosphere matrix is solved with the chosen backend (bw2calc uses lca.solver when it is set)
+def lci(lca, backend='auto'):
+    lca.load_lci_data()
+    lca.build_demand_array()
+    lca.solver = solver(lca.technosphere_matrix, backend)
+    lca.lci_calculation()
+    return lca
+
+
+# compares the backends on the technosphere matrix of the tidy tables in 'dirpath' (or on a given 'matrix'):
+# setup and mean solve time for 'demands' random unit demands and the largest relative residual
+def benchmark(dirpath='bonsai_data', matrix=None, backends=BACKENDS, demands=5, seed=0):
+    matrix = load_technosphere(dirpath) if matrix is None else sparse.csc_matrix(matrix)
+    rng = np.random.default_rng(seed)
+    columns = rng.choice(matrix.shape[0], size=demands, replace=False)
+    chosen = choose_backend(matrix)
+    rows = []
+    for backend in backends:
+        row = {'backend': backend, 'chosen': backend == chosen, 'size': matrix.shape[0],
+               'density': matrix.nnz / matrix.shape[0] ** 2}
+        try:
+            start = time.perf_counter()
+            solve = solver(matrix, backend)
+            row['setup [s]'] = time.perf_counter() - start
+            residual, start = 0.0, time.perf_counter()
+            for column in columns:
+                b = np.zeros(matrix.shape[0])
+                b[column] = 1
+                residual = max(residual, np.linalg.norm(matrix @ solve(b) - b) / np.linalg.norm(b))
+            row['solve [s]'] = (time.perf_counter() - start) / demands
+            row['residual'] = residual
+        except RuntimeError as error:
+            row['error'] = str(error)
+        rows.append(row)
+    return pd.DataFrame(rows)